@@ -9,6 +9,8 @@
 from typing import Union, List, Tuple, Iterable
 import time
 import json
+import threading
+from urllib.parse import urlencode
 import requests
 import urllib3
 try:
@@ -21,6 +23,27 @@ from app_outcome import AppOutcome
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+class InFlightCounter:
+    """ Number of HTTP requests sent and not answered yet, incremented and decremented around each request.
+    The request time is taken inside the counter, so waiting for its lock is not measured. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.value += 1
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.value -= 1
+
+
+# Requests in flight of all the AppInterface instances (e.g. of all the simulated users)
+IN_FLIGHT = InFlightCounter()
+
+
 # Create class from functions below
 class AppInterface:
     """ Class that contains methods usefull to test a web app. """
@@ -37,48 +60,56 @@ class AppInterface:
         :param endpoint: Endpoint to make the request to (e.g. / or /account)
         :return: A tuple (success, body) where success is True if the request was successful, False otherwise, and body is the body of the response
         '''
-        st = time.time()
         try:
-            response = self.s.get(self.BASE_URL + endpoint,
-                                  timeout=self.timeout, verify=False)
+            with IN_FLIGHT:
+                st = time.time()
+                try:
+                    response = self.s.get(self.BASE_URL + endpoint,
+                                          timeout=self.timeout, verify=False)
+                finally:
+                    req_time = time.time() - st
 
-            return [AppOutcome.from_response(time.time() - st, endpoint, response)]
+            return [AppOutcome.from_response(req_time, endpoint, response)]
 
         except Exception as e:
             # Return false and info about exception
-            return [AppOutcome.from_exception(time.time() - st, endpoint, e)]
+            return [AppOutcome.from_exception(req_time, endpoint, e)]
 
     def simple_post(self, endpoint, data) -> List[AppOutcome]:
         ''' Makes a POST request to the specified URL.
         :param endpoint: Endpoint to make the request to (e.g. / or /account)
-        :param data: Data to send in the POST request (e.g. {"username": "test", "password": "test"})
+        :param data: Data to send in the POST request (e.g. {"username": "test", "password": "test"}), or the same data already form-encoded (bytes, see data_feeder.encode_form)
         :return: A tuple (success, body) where success is True if the request was successful, False otherwise, and body is the body of the response
         '''
-        assert isinstance(data, dict), "Data must be a dictionary"
+        assert isinstance(data, (dict, bytes)), "Data must be a dictionary or form-encoded bytes"
 
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7'
         }
 
-        st = time.time()
         try:
-            response = self.s.post(self.BASE_URL + endpoint, data=data,
-                                   timeout=self.timeout, verify=False, headers=headers)
+            with IN_FLIGHT:
+                st = time.time()
+                try:
+                    response = self.s.post(self.BASE_URL + endpoint, data=data,
+                                           timeout=self.timeout, verify=False, headers=headers)
+                finally:
+                    req_time = time.time() - st
 
-            return [AppOutcome.from_response(time.time() - st, endpoint, response)]
+            return [AppOutcome.from_response(req_time, endpoint, response)]
 
         except Exception as e:
-            return [AppOutcome.from_exception(time.time() - st, endpoint, e)]
+            return [AppOutcome.from_exception(req_time, endpoint, e)]
 
     def get_token_and_post(self, token_endpoint, post_endpoint, data) -> List[AppOutcome]:
         ''' Makes a POST request to the specified URL.
         :param token_endpoint: Endpoint to make the request to to get the token (e.g. / or /account)
         :param post_endpoint: Endpoint to make the request to (e.g. / or /account)
-        :param data: Data to send in the POST request (e.g. {"username": "test", "password": "test"})
+        :param data: Data to send in the POST request (e.g. {"username": "test", "password": "test"}), or the same data already form-encoded (bytes, see data_feeder.encode_form)
         :return: A tuple (success, body) where success is True if the request was successful, False otherwise, and body is the body of the response
         '''
-        assert isinstance(data, dict), "Data must be a dictionary"
+        assert isinstance(data, (dict, bytes)), "Data must be a dictionary or form-encoded bytes"
 
         # Get page with token
         outcome_get = self.simple_get(token_endpoint)
@@ -94,8 +125,13 @@ class AppInterface:
             return [AppOutcome.from_exception(sum(o.req_time for o in outcome_get), token_endpoint, e)]
 
         # Post
-        outcome_post = self.simple_post(
-            post_endpoint, {"__RequestVerificationToken": token, **data})
+        if isinstance(data, bytes):
+            token_data = urlencode({"__RequestVerificationToken": token}).encode("utf-8")
+            post_data = token_data + b"&" + data if data else token_data
+        else:
+            post_data = {"__RequestVerificationToken": token, **data}
+
+        outcome_post = self.simple_post(post_endpoint, post_data)
 
         return outcome_get + outcome_post
 
@@ -0,0 +1,327 @@
+# Description: Labelled metrics aggregated by action, endpoint and status class.
+
+# pylint: disable=C0103
+
+import math
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from app_outcome import AppOutcome
+
+OVERFLOW_LABEL = "__other__"  # Label used once the cardinality cap of a dimension is reached
+DIMENSIONS = ("action", "endpoint", "status")
+
+# Default latency histogram layout: log-linear buckets, SUB_BUCKETS per power of two,
+# starting at HIST_MIN seconds. Bucket i > 0 covers [HIST_MIN * 2^((i - 1) / SUB_BUCKETS), HIST_MIN * 2^(i / SUB_BUCKETS))
+HIST_MIN = 0.001
+SUB_BUCKETS = 8
+HIST_OCTAVES = 18  # 1 ms * 2^18 ~ 262 s
+HIST_SIZE = HIST_OCTAVES * SUB_BUCKETS + 2  # + underflow and overflow buckets
+
+
+def bucket_upper_bound(index: int, min_value: float = HIST_MIN, size: int = HIST_SIZE) -> float:
+    """ Returns the upper bound (in seconds) of the given histogram bucket, for a histogram starting at min_value with size buckets. """
+    if index >= size - 1:
+        return math.inf
+    return min_value * 2 ** (index / SUB_BUCKETS)
+
+
+def action_name(action) -> str:
+    """ Returns the name under which the outcomes of an action are aggregated. """
+    return action if isinstance(action, str) else getattr(action, "__name__", str(action))
+
+
+def status_class(status_code: int) -> str:
+    """ Returns the status class of a status code (e.g. 404 -> 4xx, exceptions -> error). """
+    if status_code == 999 or status_code is None:
+        return "error"
+    return f"{status_code // 100}xx"
+
+
+def strip_query(endpoint: str) -> str:
+    """ Default endpoint normalizer: drops the query string and the fragment. """
+    return endpoint.split("?", 1)[0].split("#", 1)[0]
+
+
+class LabelInterner:
+    """Maps label strings to small integer IDs, with a cardinality cap."""
+
+    def __init__(self, max_cardinality: int = 256):
+        """
+        :param max_cardinality: Maximum number of distinct labels, further labels are mapped to OVERFLOW_LABEL
+        """
+        assert max_cardinality > 1, "Max cardinality must be greater than 1"
+
+        self.max_cardinality = max_cardinality
+        self.names = [OVERFLOW_LABEL]
+        self.ids = {OVERFLOW_LABEL: 0}
+        self.overflowed = 0  # Number of lookups that were mapped to the overflow label
+
+    def intern(self, name: str) -> int:
+        """ Returns the ID of the given label, creating it if the cap is not reached. """
+        label_id = self.ids.get(name)
+        if label_id is not None:
+            return label_id
+
+        if len(self.names) >= self.max_cardinality:
+            self.overflowed += 1
+            return 0
+
+        label_id = len(self.names)
+        self.names.append(name)
+        self.ids[name] = label_id
+        return label_id
+
+    def name(self, label_id: int) -> str:
+        """ Returns the label of the given ID. """
+        return self.names[label_id]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class LatencyHistogram:
+    """Fixed-size log-linear histogram, O(1) to record and cheap to query for percentiles."""
+
+    __slots__ = ("counts", "count", "min_value")
+
+    def __init__(self, min_value: float = HIST_MIN, octaves: int = HIST_OCTAVES):
+        """
+        :param min_value: Upper bound (s) of the underflow bucket, e.g. 1e-6 for durations of a few microseconds
+        :param octaves: Number of powers of two covered above min_value, larger values go to the overflow bucket
+        """
+        assert min_value > 0, "Min value must be greater than 0"
+        assert octaves > 0, "Number of octaves must be greater than 0"
+
+        self.counts = [0] * (octaves * SUB_BUCKETS + 2)
+        self.count = 0
+        self.min_value = min_value
+
+    def bucket_index(self, value: float) -> int:
+        """ Returns the index of the bucket containing the given value (in seconds). """
+        if value < self.min_value:
+            return 0
+        index = int(math.log2(value / self.min_value) * SUB_BUCKETS) + 1
+        return index if index < len(self.counts) else len(self.counts) - 1
+
+    def record(self, value: float):
+        """ Records a value (in seconds). """
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+
+    def merge(self, other: 'LatencyHistogram'):
+        """ Adds the counts of another histogram with the same layout to this one. """
+        assert self.min_value == other.min_value and len(self.counts) == len(other.counts), "Histogram layouts differ"
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns an upper bound of the p-th percentile (within one bucket, ~9%).
+
+        :param p: Percentile between 0 and 100
+        """
+        if self.count == 0:
+            return 0
+
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return bucket_upper_bound(i, self.min_value, len(self.counts))
+        return math.inf
+
+
+class SeriesStats:
+    """Aggregated values of one label set."""
+
+    __slots__ = ("count", "successes", "invalid", "total_time", "min_time", "max_time", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.successes = 0
+        self.invalid = 0  # Requests counted as successes, then rejected by a validator
+        self.total_time = 0.0
+        self.min_time = math.inf
+        self.max_time = 0.0
+        self.histogram = LatencyHistogram()
+
+    def record(self, req_time: float, success: bool):
+        """ Records one request. """
+        self.count += 1
+        self.successes += success
+        self.total_time += req_time
+        if req_time < self.min_time:
+            self.min_time = req_time
+        if req_time > self.max_time:
+            self.max_time = req_time
+        self.histogram.record(req_time)
+
+    def merge(self, other: 'SeriesStats'):
+        """ Adds the values of another series to this one. """
+        self.count += other.count
+        self.successes += other.successes
+        self.invalid += other.invalid
+        self.total_time += other.total_time
+        self.min_time = min(self.min_time, other.min_time)
+        self.max_time = max(self.max_time, other.max_time)
+        self.histogram.merge(other.histogram)
+
+    def percentile(self, p: float) -> float:
+        """ Returns the p-th percentile, bounded by the max observed time. """
+        return min(self.histogram.percentile(p), self.max_time)
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.count if self.count > 0 else 0
+
+    @property
+    def success_rate(self) -> float:
+        return self.successes / self.count if self.count > 0 else 0
+
+
+class LabelledMetrics:
+    """Aggregates outcomes by (action, endpoint, status class), with interned labels.
+
+    Not thread safe: it is meant to be fed by the thread draining the result queue.
+    """
+
+    def __init__(self, max_actions: int = 64, max_endpoints: int = 256,
+                 normalize_endpoint: Callable[[str], str] = strip_query):
+        """
+        :param max_actions: Cardinality cap of the action dimension
+        :param max_endpoints: Cardinality cap of the endpoint dimension (protects against templated URLs)
+        :param normalize_endpoint: Function applied to url_requested before interning
+        """
+        self.interners = (LabelInterner(max_actions),
+                          LabelInterner(max_endpoints),
+                          LabelInterner(16))
+        self.normalize_endpoint = normalize_endpoint
+        self.series: Dict[Tuple[int, int, int], SeriesStats] = {}
+        self.key_cache: Dict[Tuple[str, str, int], Tuple[int, int, int]] = {}
+        self.key_cache_size = 4096  # Raw URLs are not capped, so neither is the cache without this limit
+
+    def labels_of(self, action: str, outcome: AppOutcome) -> Tuple[int, int, int]:
+        """ Returns the interned label set of an outcome. """
+        raw = (action, outcome.url_requested, outcome.status_code)
+        key = self.key_cache.get(raw)
+        if key is not None:
+            # Cache hits skip intern, so the lookups mapped to the overflow label (ID 0) are counted here
+            if 0 in key:
+                for interner, label_id in zip(self.interners, key):
+                    if label_id == 0:
+                        interner.overflowed += 1
+            return key
+
+        actions, endpoints, statuses = self.interners
+        key = (actions.intern(action),
+               endpoints.intern(self.normalize_endpoint(outcome.url_requested)),
+               statuses.intern(status_class(outcome.status_code)))
+        if len(self.key_cache) < self.key_cache_size:
+            self.key_cache[raw] = key
+        return key
+
+    def series_of(self, key: Tuple[int, int, int]) -> SeriesStats:
+        """ Returns the series of an interned label set, created if needed. """
+        stats = self.series.get(key)
+        if stats is None:
+            stats = self.series[key] = SeriesStats()
+        return stats
+
+    def record(self, action: str, outcome: AppOutcome) -> Tuple[int, int, int]:
+        """ Records one outcome of the given action and returns its label set. """
+        key = self.labels_of(action, outcome)
+        self.series_of(key).record(outcome.req_time, outcome.success)
+        return key
+
+    def record_all(self, action: str, outcomes: Iterable[AppOutcome]) -> List[Tuple[int, int, int]]:
+        """ Records all the outcomes of one action and returns their label sets. """
+        return [self.record(action, outcome) for outcome in outcomes]
+
+    def invalidate(self, key: Tuple[int, int, int]):
+        """ Turns one success of the given label set into a failure (e.g. rejected by a validator). """
+        stats = self.series[key]
+        stats.successes -= 1
+        stats.invalid += 1
+
+    def label_names(self, key: Tuple[int, int, int]) -> Tuple[str, str, str]:
+        """ Returns the label strings of an interned label set. """
+        return tuple(interner.name(i) for interner, i in zip(self.interners, key))
+
+    def summary(self, *dimensions: str) -> Dict[Tuple[str, ...], SeriesStats]:
+        """
+        Returns the series merged over the given dimensions.
+
+        :param dimensions: Names of the dimensions to keep (see DIMENSIONS), e.g. summary("endpoint")
+        """
+        positions = [DIMENSIONS.index(d) for d in dimensions]
+
+        merged: Dict[Tuple[int, ...], SeriesStats] = {}
+        for key, stats in self.series.items():
+            sub_key = tuple(key[p] for p in positions)
+            if sub_key not in merged:
+                merged[sub_key] = SeriesStats()
+            merged[sub_key].merge(stats)
+
+        return {tuple(self.interners[p].name(i) for p, i in zip(positions, sub_key)): stats
+                for sub_key, stats in merged.items()}
+
+    def format_table(self, *dimensions: str) -> str:
+        """ Returns a printable table of the series merged over the given dimensions. """
+        dimensions = dimensions or DIMENSIONS
+        lines = [" | ".join(dimensions) +
+                 " | count | success rate | invalid | avg (s) | p50 (s) | p99 (s) | max (s)"]
+        for labels, s in sorted(self.summary(*dimensions).items()):
+            lines.append(" | ".join(labels) +
+                         f" | {s.count} | {s.success_rate:.3f} | {s.invalid} | {s.avg_time:.3f}"
+                         f" | {s.percentile(50):.3f} | {s.percentile(99):.3f} | {s.max_time:.3f}")
+        return "\n".join(lines)
+
+
+def main():
+    """ Tests that the classes work as expected. """
+    interner = LabelInterner(3)
+    assert interner.intern("a") == 1
+    assert interner.intern("b") == 2
+    assert interner.intern("c") == 0
+    assert interner.intern("a") == 1
+    assert interner.overflowed == 1
+
+    h = LatencyHistogram()
+    for i in range(1, 1001):
+        h.record(i / 1000)
+    assert 0.99 <= h.percentile(99) <= 0.99 * 2 ** (1 / SUB_BUCKETS)
+    assert h.percentile(100) >= 1
+
+    fine = LatencyHistogram(1e-6, 26)
+    for i in range(1, 101):
+        fine.record(i * 1e-6)
+    assert 50e-6 <= fine.percentile(50) <= 50e-6 * 2 ** (1 / SUB_BUCKETS)
+    assert h.percentile(50) >= 0.5 and LatencyHistogram().bucket_index(50e-6) == 0
+
+    metrics = LabelledMetrics(max_endpoints=3)
+    metrics.record_all("login", [
+        AppOutcome(0.1, "", 200, "/login?x=1", "/"),
+        AppOutcome(0.3, "", 302, "/login", "/")])
+    metrics.record("browse", AppOutcome(0.2, "", 200, "/item/1", "/"))
+    metrics.record("browse", AppOutcome(0.2, "", 999, "/item/2", "EXCEPTION"))
+
+    assert metrics.interners[1].overflowed == 1
+    metrics.record("browse", AppOutcome(0.2, "", 999, "/item/2", "EXCEPTION"))
+    assert metrics.interners[1].overflowed == 2, "Cached keys must count their overflows too"
+
+    by_endpoint = metrics.summary("endpoint")
+    assert by_endpoint[("/login",)].count == 2
+    assert by_endpoint[(OVERFLOW_LABEL,)].count == 2
+    assert metrics.summary("status")[("error",)].success_rate == 0
+    assert metrics.summary()[()].count == 5
+
+    metrics.invalidate(metrics.labels_of("browse", AppOutcome(0.2, "", 200, "/item/1", "/")))
+    assert metrics.summary("action")[("browse",)].successes == 0
+    assert metrics.summary("action")[("browse",)].invalid == 1
+    print(metrics.format_table())
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# Description: Response validators run off the user threads, after the timing is recorded.
+
+# Ignore too general except clause
+# pylint: disable=W0703
+# pylint: disable=C0103
+
+import json
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Hashable, Iterable, List, Tuple
+
+from app_outcome import AppOutcome
+
+
+class ContainsMarker:
+    """Checks that the body of the response contains a marker (e.g. "Welcome back")."""
+
+    def __init__(self, marker: str):
+        self.marker = marker
+
+    def __call__(self, outcome: AppOutcome) -> bool:
+        return self.marker in outcome.body
+
+    def __repr__(self):
+        return f"ContainsMarker({self.marker!r})"
+
+
+class JsonShape:
+    """Checks that the body of the response is a JSON object containing the given keys."""
+
+    def __init__(self, *keys: str):
+        self.keys = keys
+
+    def __call__(self, outcome: AppOutcome) -> bool:
+        try:
+            content = json.loads(outcome.body)
+        except ValueError:
+            return False
+        return isinstance(content, dict) and all(key in content for key in self.keys)
+
+    def __repr__(self):
+        return f"JsonShape{self.keys!r}"
+
+
+class RedirectsTo:
+    """Checks that the request ended on the expected URL (compared to url_returned)."""
+
+    def __init__(self, endpoint: str):
+        """
+        :param endpoint: Expected end of url_returned (e.g. /account), the query string is ignored
+        """
+        self.endpoint = endpoint
+
+    def __call__(self, outcome: AppOutcome) -> bool:
+        return outcome.url_returned.split("?", 1)[0].endswith(self.endpoint)
+
+    def __repr__(self):
+        return f"RedirectsTo({self.endpoint!r})"
+
+
+def validate_batch(validators: Dict[str, List[Any]], batch: List[Tuple[Hashable, str, AppOutcome]]) -> List[Tuple[Hashable, bool]]:
+    """
+    Runs the validators of each action on a batch of outcomes.
+    Module level so that it can be sent to a process pool.
+
+    :param validators: Validators of each action name
+    :param batch: List of (key, action name, outcome)
+    :return: Verdict of each outcome: (key, True if all the validators accepted it)
+    """
+    verdicts = []
+    for key, action_name, outcome in batch:
+        valid = True
+        for validator in validators.get(action_name, ()):
+            try:
+                valid = bool(validator(outcome))
+            except Exception:
+                valid = False
+
+            if not valid:
+                break
+
+        verdicts.append((key, valid))
+
+    return verdicts
+
+
+class ValidationPipeline:
+    """Batches outcomes and validates them in a worker pool.
+
+    submit and collect are meant to be called from a single thread (the one draining the result queue),
+    the user threads never run validators so the measured times are not affected.
+    """
+
+    def __init__(self, validators: Dict[str, List[Any]], batch_size: int = 64, workers: int = 2,
+                 use_processes: bool = False):
+        """
+        :param validators: Validators of each action name. A validator is a callable taking an AppOutcome and returning True if it is valid.
+            Validators must be picklable when use_processes is True (e.g. ContainsMarker, JsonShape, RedirectsTo)
+        :param batch_size: Number of outcomes sent to a worker at once
+        :param workers: Number of workers of the pool
+        :param use_processes: Use a process pool instead of a thread pool (for CPU heavy validators)
+        """
+        assert batch_size > 0, "Batch size must be greater than 0"
+        assert workers > 0, "Number of workers must be greater than 0"
+
+        self.validators = {name: list(v) for name, v in validators.items() if v}
+        self.batch_size = batch_size
+        self.executor: Executor = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(
+            max_workers=workers)
+
+        self.batch = []
+        self.futures = []
+        self.validated = 0  # Number of outcomes sent to the workers
+
+    def will_validate(self, action_name: str, outcome: AppOutcome) -> bool:
+        """ Returns True if submit queues this outcome, i.e. if collect will return its verdict. """
+        return outcome.success and action_name in self.validators
+
+    def submit(self, action_name: str, keyed_outcomes: Iterable[Tuple[Hashable, AppOutcome]]):
+        """
+        Queues outcomes for validation. Outcomes that already failed are skipped.
+
+        :param action_name: Name of the action that produced the outcomes
+        :param keyed_outcomes: Iterable of (key, outcome), the key is returned by collect with the verdict of the outcome
+        """
+        for key, outcome in keyed_outcomes:
+            if self.will_validate(action_name, outcome):
+                self.batch.append((key, action_name, outcome))
+
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    @property
+    def pending_batches(self) -> int:
+        """ Number of batches sent to the workers and not collected yet. """
+        return len(self.futures)
+
+    def flush(self):
+        """ Sends the current partial batch to the workers. """
+        if self.batch:
+            self.futures.append(self.executor.submit(validate_batch, self.validators, self.batch))
+            self.validated += len(self.batch)
+            self.batch = []
+
+    def collect(self) -> List[Tuple[Hashable, bool]]:
+        """ Returns the verdicts (key, valid) of the batches that are done, without blocking. """
+        verdicts = []
+        pending = []
+        for future in self.futures:
+            if future.done():
+                verdicts.extend(future.result())
+            else:
+                pending.append(future)
+
+        self.futures = pending
+        return verdicts
+
+    def close(self) -> List[Tuple[Hashable, bool]]:
+        """ Validates the remaining outcomes, shuts the pool down and returns the remaining verdicts. """
+        self.flush()
+        self.executor.shutdown(wait=True)
+        return self.collect()
+
+
+def main():
+    """ Tests that the pipeline works as expected. """
+    ok = AppOutcome(0.1, '{"user": "test", "id": 1}', 200, "/api/me", "https://test/api/me")
+    bad_json = AppOutcome(0.1, "<html></html>", 200, "/api/me", "https://test/api/me")
+    login = AppOutcome(0.1, "Welcome", 200, "/login", "https://test/account?x=1")
+    failed = AppOutcome(0.1, "", 500, "/login", "https://test/login")
+
+    pipeline = ValidationPipeline({
+        "me": [JsonShape("user", "id")],
+        "login": [RedirectsTo("/account"), ContainsMarker("Welcome")],
+    }, batch_size=2)
+
+    pipeline.submit("me", [(1, ok), (2, bad_json)])
+    pipeline.submit("login", [(3, login), (4, failed)])
+    pipeline.submit("other", [(5, bad_json)])
+
+    assert pipeline.will_validate("login", login) and not pipeline.will_validate("login", failed)
+    assert not pipeline.will_validate("other", ok)
+    assert sorted(pipeline.close()) == [(1, True), (2, False), (3, True)]
+    assert pipeline.validated == 3
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# Description: Feeders streaming records (credentials, payloads) from large CSV or JSON lines files.
+
+# pylint: disable=C0103
+
+import abc
+import csv
+import functools
+import json
+import mmap
+import os
+import random
+import threading
+from array import array
+from enum import Enum
+from typing import Tuple, Union
+from urllib.parse import urlencode
+
+
+def encode_form(data: dict) -> bytes:
+    """ Encodes form data once, the result can be given to AppInterface.simple_post instead of a dictionary. """
+    return urlencode(data).encode("utf-8")
+
+
+class FeederExhausted(Exception):
+    """Raised when a feeder with the UNIQUE allocation has given all its records, or when its file has no record."""
+
+
+class FileFeeder(abc.ABC):
+    """Gives records of a file, one per line, without loading the file in memory.
+
+    The file is memory-mapped and lines are read when they are needed. The feeder is safe to
+    share between the user threads. Records are cached (parsed, and encoded if encode is True)
+    in an LRU cache of cache_size entries: the returned records must not be modified.
+    """
+
+    class Allocation(Enum):
+        """How records are given to the users."""
+
+        UNIQUE = 1  # Each record is given once, then FeederExhausted is raised
+        ROUND_ROBIN = 2  # Records are given in order, starting over at the end of the file
+        RANDOM = 3  # Records are drawn uniformly (with replacement)
+
+    def __init__(self, path: str, allocation: 'FileFeeder.Allocation' = Allocation.ROUND_ROBIN,
+                 encode: bool = False, cache_size: int = 1024, seed: int = None):
+        """
+        :param path: Path of the file
+        :param allocation: How records are given to the users
+        :param encode: If True, records are returned form-encoded (bytes) instead of as dictionaries
+        :param cache_size: Number of records kept parsed in memory
+        :param seed: Seed of the RANDOM allocation
+        """
+        self.path = path
+        self.allocation = allocation
+        self.encode = encode
+
+        if os.path.getsize(path) == 0:
+            raise FeederExhausted(f"{path} is empty")
+
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.data_start = self._header_end()
+        self.cursor = self.data_start
+        self.offsets = None  # Start of each line, only built for the RANDOM allocation
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.__record = functools.lru_cache(maxsize=cache_size)(self.__load)
+
+    def _header_end(self) -> int:
+        """ Returns the offset of the first record. """
+        return 0
+
+    @abc.abstractmethod
+    def _parse(self, line: str) -> dict:
+        """ Parses one line of the file. """
+
+    def __load(self, start: int, end: int) -> Union[dict, bytes]:
+        record = self._parse(self.mm[start:end].decode("utf-8").rstrip("\r"))
+        return encode_form(record) if self.encode else record
+
+    def __line_end(self, start: int) -> int:
+        end = self.mm.find(b"\n", start)
+        return len(self.mm) if end == -1 else end
+
+    def __next_line(self) -> Tuple[int, int]:
+        """ Returns the bounds of the next non empty line, with the lock held. """
+        size = len(self.mm)
+        wrapped = False
+
+        while True:
+            if self.cursor >= size:
+                if self.allocation == self.Allocation.UNIQUE or wrapped:
+                    raise FeederExhausted(self.path)
+                self.cursor = self.data_start
+                wrapped = True
+
+            start = self.cursor
+            end = self.__line_end(start)
+            self.cursor = end + 1
+
+            if self.mm[start:end].strip():
+                return start, end
+
+    def __index(self):
+        """ Builds the offsets of the lines, with the lock held (8 bytes per line). """
+        offsets = array("Q")
+        start = self.data_start
+        size = len(self.mm)
+        while start < size:
+            end = self.__line_end(start)
+            if self.mm[start:end].strip():
+                offsets.append(start)
+            start = end + 1
+
+        if len(offsets) == 0:
+            raise FeederExhausted(self.path)
+        self.offsets = offsets
+
+    def next(self) -> Union[dict, bytes]:
+        """ Returns the next record according to the allocation. """
+        with self.lock:
+            if self.allocation == self.Allocation.RANDOM:
+                if self.offsets is None:
+                    self.__index()
+                start = self.offsets[self.random.randrange(len(self.offsets))]
+                end = self.__line_end(start)
+            else:
+                start, end = self.__next_line()
+
+        return self.__record(start, end)
+
+    def __call__(self, user_id: int = None) -> Union[dict, bytes]:
+        """ Same as next, so that a feeder can be used as the data of a LoginFlow. """
+        return self.next()
+
+    def close(self):
+        """ Closes the file. """
+        self.__record.cache_clear()
+        self.mm.close()
+        self.file.close()
+
+
+class CsvFeeder(FileFeeder):
+    """Feeder of a CSV file whose first line is the header. Quoted fields can not contain line breaks."""
+
+    def _header_end(self) -> int:
+        end = self.mm.find(b"\n")
+        end = len(self.mm) if end == -1 else end
+        self.fields = next(csv.reader([self.mm[:end].decode("utf-8-sig").rstrip("\r")]))
+        return end + 1
+
+    def _parse(self, line: str) -> dict:
+        return dict(zip(self.fields, next(csv.reader([line]))))
+
+
+class JsonLinesFeeder(FileFeeder):
+    """Feeder of a JSON lines file (one JSON object per line)."""
+
+    def _parse(self, line: str) -> dict:
+        return json.loads(line)
+
+
+def main():
+    """ Tests that the feeders work as expected. """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        csv_path = os.path.join(d, "users.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write("Input.Email,Input.Password\r\na@test.com,\"p,1\"\r\n\r\nb@test.com,p2\r\n")
+
+        feeder = CsvFeeder(csv_path, FileFeeder.Allocation.UNIQUE)
+        assert feeder.next() == {"Input.Email": "a@test.com", "Input.Password": "p,1"}
+        assert feeder.next() == {"Input.Email": "b@test.com", "Input.Password": "p2"}
+        try:
+            feeder.next()
+            assert False, "Feeder should be exhausted"
+        except FeederExhausted:
+            pass
+        feeder.close()
+
+        feeder = CsvFeeder(csv_path, FileFeeder.Allocation.ROUND_ROBIN, encode=True)
+        assert [feeder() for _ in range(3)] == [
+            b"Input.Email=a%40test.com&Input.Password=p%2C1",
+            b"Input.Email=b%40test.com&Input.Password=p2",
+            b"Input.Email=a%40test.com&Input.Password=p%2C1"]
+        feeder.close()
+
+        empty_path = os.path.join(d, "empty.csv")
+        open(empty_path, "w", encoding="utf-8").close()
+        try:
+            CsvFeeder(empty_path)
+            assert False, "Empty file should raise FeederExhausted"
+        except FeederExhausted:
+            pass
+
+        jsonl_path = os.path.join(d, "payloads.jsonl")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(json.dumps({"id": i}) for i in range(100)))
+
+        feeder = JsonLinesFeeder(jsonl_path, FileFeeder.Allocation.RANDOM, seed=1)
+        ids = [feeder.next()["id"] for _ in range(1000)]
+        assert min(ids) == 0 and max(ids) == 99 and len(feeder.offsets) == 100
+        feeder.close()
+
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# Description: Instrumentation of the load generator itself, to detect when the client is the bottleneck.
+
+# pylint: disable=C0103
+
+import collections
+import gc
+import time
+from typing import Dict, List
+
+from app_metrics import LatencyHistogram
+
+# The loop iterations and start lags last a few microseconds when the generator is healthy,
+# so they use a finer histogram than the request times: 1 us to 1 us * 2^26 ~ 67 s
+FINE_MIN = 1e-6
+FINE_OCTAVES = 26
+
+
+def bounded_percentile(histogram: LatencyHistogram, p: float, max_value: float) -> float:
+    """ Returns the p-th percentile of the histogram, bounded by the max observed value. """
+    return min(histogram.percentile(p), max_value)
+
+
+class HarnessMonitor:
+    """Measures the scheduler loop, the user start lag, the CPU and the GC pauses of the load generator.
+
+    record_start and the GC callback may be called from any thread: they only append to deques,
+    which are drained by sample on the scheduler thread.
+    """
+
+    def __init__(self, loop_threshold: float = 0.05, lag_threshold: float = 0.5, cpu_threshold: float = 0.9):
+        """
+        :param loop_threshold: Max duration (s) of a scheduler loop iteration before the generator is considered saturated
+        :param lag_threshold: Max p99 (s) of the lag between the intended and the actual start of the users
+        :param cpu_threshold: Max CPU usage of the process outside of the scheduler thread (1 = one core, the GIL limits Python threads to about one core).
+            The scheduler thread is excluded because its loop never sleeps
+        """
+        self.loop_threshold = loop_threshold
+        self.lag_threshold = lag_threshold
+        self.cpu_threshold = cpu_threshold
+
+        # Whole run
+        self.loop_times = LatencyHistogram(FINE_MIN, FINE_OCTAVES)
+        self.start_lags = LatencyHistogram(FINE_MIN, FINE_OCTAVES)
+        self.gc_pauses = LatencyHistogram(FINE_MIN, FINE_OCTAVES)
+        self.loop_max = 0.0
+        self.lag_max = 0.0
+        self.gc_max = 0.0
+        self.gc_total = 0.0
+        self.saturation_warnings = 0
+
+        # Current window (since the last sample)
+        self.window_loop_max = 0.0
+        self.window_lags = collections.deque()
+        self.window_gc = collections.deque()
+        self.pending_starts = collections.deque()  # Intended start times of the users not launched yet
+
+        self.gc_started = None
+        self.last_sample = (time.time(), time.process_time(), time.thread_time())
+        self.last_report = {}
+
+    def start(self):
+        """ Starts measuring the GC pauses. """
+        gc.callbacks.append(self.__on_gc)
+
+    def stop(self):
+        """ Stops measuring the GC pauses. """
+        if self.__on_gc in gc.callbacks:
+            gc.callbacks.remove(self.__on_gc)
+
+    def __on_gc(self, phase, info):
+        if phase == "start":
+            self.gc_started = time.perf_counter()
+        elif self.gc_started is not None:
+            self.window_gc.append(time.perf_counter() - self.gc_started)
+            self.gc_started = None
+
+    def record_loop(self, duration: float):
+        """ Records the duration of one iteration of the scheduler loop. """
+        self.loop_times.record(duration)
+        if duration > self.window_loop_max:
+            self.window_loop_max = duration
+
+    def update_deficit(self, missing_users: int):
+        """
+        Tracks since when users are missing, called by the scheduler at each iteration.
+
+        :param missing_users: Number of users that should be running but are not launched yet
+        """
+        now = time.time()
+        while len(self.pending_starts) < missing_users:
+            self.pending_starts.append(now)
+        while self.pending_starts and len(self.pending_starts) > max(missing_users, 0):
+            self.pending_starts.pop()
+
+    def intended_start(self) -> float:
+        """ Returns the time at which the user being launched should have started. """
+        return self.pending_starts.popleft() if self.pending_starts else time.time()
+
+    def record_start(self, intended_start: float):
+        """ Records the actual start of a user, called from the user thread. """
+        self.window_lags.append(time.time() - intended_start)
+
+    def sample(self, thread_count: int, queue_depths: Dict[str, int]) -> dict:
+        """
+        Closes the current window and returns its report. Must be called from the scheduler thread.
+
+        :param thread_count: Number of threads alive
+        :param queue_depths: Number of items waiting in each queue of the harness
+        :return: Report of the window, with the reasons of the saturation in "saturation" (empty if not saturated)
+        """
+        now, cpu, scheduler_cpu = time.time(), time.process_time(), time.thread_time()
+        wall = now - self.last_sample[0]
+        cpu_usage = (cpu - self.last_sample[1]) / wall if wall > 0 else 0
+        scheduler_usage = (scheduler_cpu - self.last_sample[2]) / wall if wall > 0 else 0
+        self.last_sample = (now, cpu, scheduler_cpu)
+        workers_usage = max(0, cpu_usage - scheduler_usage)
+
+        window_lags = LatencyHistogram(FINE_MIN, FINE_OCTAVES)
+        window_lag_max = 0.0
+        while self.window_lags:
+            lag = self.window_lags.popleft()
+            window_lags.record(lag)
+            window_lag_max = max(window_lag_max, lag)
+        self.start_lags.merge(window_lags)
+        self.lag_max = max(self.lag_max, window_lag_max)
+        lag_p99 = bounded_percentile(window_lags, 99, window_lag_max)
+
+        window_gc = 0.0
+        while self.window_gc:
+            pause = self.window_gc.popleft()
+            self.gc_pauses.record(pause)
+            self.gc_max = max(self.gc_max, pause)
+            window_gc += pause
+        self.gc_total += window_gc
+
+        loop_max = self.window_loop_max
+        self.loop_max = max(self.loop_max, loop_max)
+        self.window_loop_max = 0.0
+
+        saturation = []
+        if workers_usage >= self.cpu_threshold:
+            saturation.append(f"CPU usage {workers_usage:.0%}")
+        if lag_p99 >= self.lag_threshold:
+            saturation.append(f"p99 start lag {lag_p99:.3f}s")
+        if loop_max >= self.loop_threshold:
+            saturation.append(f"scheduler loop {loop_max:.3f}s")
+
+        if saturation:
+            self.saturation_warnings += 1
+
+        self.last_report = {
+            "cpu_usage": cpu_usage,
+            "scheduler_cpu_usage": scheduler_usage,
+            "threads": thread_count,
+            "queue_depths": dict(queue_depths),
+            "loop_max": loop_max,
+            "start_lag_p99": lag_p99,
+            "gc_pause": window_gc,
+            "saturation": saturation,
+        }
+        return self.last_report
+
+    def summary(self) -> List[str]:
+        """ Returns printable lines summarizing the whole run. """
+        return [
+            f"Scheduler loop: p50 {bounded_percentile(self.loop_times, 50, self.loop_max) * 1e6:.0f}us, "
+            f"p99 {bounded_percentile(self.loop_times, 99, self.loop_max) * 1e6:.0f}us, max {self.loop_max * 1e6:.0f}us",
+            f"User start lag: p50 {bounded_percentile(self.start_lags, 50, self.lag_max) * 1e6:.0f}us, "
+            f"p99 {bounded_percentile(self.start_lags, 99, self.lag_max) * 1e6:.0f}us, max {self.lag_max * 1e6:.0f}us",
+            f"GC pauses: {self.gc_pauses.count} for {self.gc_total * 1e3:.1f}ms, "
+            f"p99 {bounded_percentile(self.gc_pauses, 99, self.gc_max) * 1e6:.0f}us",
+            f"Saturation warnings: {self.saturation_warnings}",
+        ]
+
+
+def main():
+    """ Tests that the monitor works as expected. """
+    monitor = HarnessMonitor(loop_threshold=0.01, lag_threshold=0.05, cpu_threshold=10)
+    monitor.start()
+
+    monitor.update_deficit(3)
+    monitor.update_deficit(2)
+    assert len(monitor.pending_starts) == 2
+    intended = monitor.intended_start()
+    time.sleep(0.1)
+    monitor.record_start(intended)
+    monitor.record_loop(0.001)
+
+    gc.collect()
+    report = monitor.sample(1, {"results": 0})
+    assert report["start_lag_p99"] >= 0.1
+    assert report["saturation"] and monitor.saturation_warnings == 1
+    assert monitor.gc_pauses.count >= 1
+
+    monitor.record_loop(0.02)
+    report = monitor.sample(1, {"results": 0})
+    assert report["saturation"] == [f"scheduler loop {0.02:.3f}s"]
+
+    # Microsecond loops are resolved instead of falling in the 1 ms underflow bucket
+    for _ in range(100):
+        monitor.record_loop(20e-6)
+    assert 20e-6 <= monitor.loop_times.percentile(50) <= 20e-6 * 2 ** (1 / 8)
+    assert bounded_percentile(monitor.loop_times, 99, monitor.loop_max) <= monitor.loop_max
+
+    monitor.stop()
+    print("\n".join(monitor.summary()))
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
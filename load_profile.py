@@ -0,0 +1,186 @@
+# Description: Ramp up / full load / ramp down profile and scheduler shared by the real time and the virtual time simulators.
+
+# pylint: disable=C0103
+
+import math
+from math import ceil, floor
+from enum import Enum
+from typing import List, Tuple
+
+
+class State(Enum):
+    """State of the simulator."""
+
+    RAMP_UP = 1
+    FULL_LOAD = 2
+    RAMP_DOWN = 3
+    FINISHED = 4
+
+
+# Message printed when entering a state
+TRANSITION_MESSAGES = {
+    State.FULL_LOAD: "Ramp up finished. Starting full load.",
+    State.RAMP_DOWN: "Full load finished. Starting ramp down.",
+    State.FINISHED: "Ramp down finished.",
+}
+
+
+class LoadProfile:
+    """Number of users wanted in each state and transitions between states."""
+
+    def __init__(self, peak_users, ramp_up_time, load_time, ramp_down_time):
+        """
+        :param peak_users: Number of users to simulate at peak
+        :param ramp_up_time: Time to ramp up to peak users
+        :param load_time: Time to hold peak users
+        :param ramp_down_time: Time to ramp down to 0 users
+        """
+        assert peak_users > 0, "Peak users must be greater than 0"
+        assert ramp_up_time > 0, "Ramp up time must be greater than 0"
+        assert ramp_down_time > 0, "Ramp down time must be greater than 0"
+
+        self.peak_users = peak_users
+        self.ramp_up_time = ramp_up_time
+        self.load_time = load_time
+        self.ramp_down_time = ramp_down_time
+
+    def ideal_users(self, state: State, elapsed: float) -> int:
+        """
+        Returns the number of users that should be running.
+
+        :param state: Current state
+        :param elapsed: Time since the current state started
+        """
+        if state == State.RAMP_UP:
+            # Here we ceil the result e.g. 9.1 users -> we create a new user
+            return ceil(self.peak_users * elapsed / self.ramp_up_time)
+
+        if state == State.FULL_LOAD:
+            return self.peak_users
+
+        if state == State.RAMP_DOWN:
+            # Here we floor the result e.g. 9.9 users -> we don't create a new user
+            return floor(self.peak_users * (1 - elapsed / self.ramp_down_time))
+
+        return 0
+
+    def next_state(self, state: State, current_users: int, elapsed: float) -> State:
+        """
+        Returns the state to switch to (state itself if no transition is due).
+
+        :param state: Current state
+        :param current_users: Number of users running
+        :param elapsed: Time since the current state started
+        """
+        if state == State.RAMP_UP and current_users >= self.peak_users:
+            return State.FULL_LOAD
+
+        if state == State.FULL_LOAD and elapsed >= self.load_time:
+            return State.RAMP_DOWN
+
+        if state == State.RAMP_DOWN and current_users <= 0:
+            return State.FINISHED
+
+        return state
+
+
+class Scheduler:
+    """Steps of a run through a load profile, driven by the real time and the virtual time simulators.
+
+    At each iteration of its loop, the simulator calls step with the current time and the number of users
+    running, launches one user if it is told to and prints the states entered.
+    """
+
+    def __init__(self, profile: LoadProfile, started_at: float):
+        """
+        :param profile: Load profile to follow
+        :param started_at: Time at which the ramp up starts
+        """
+        self.profile = profile
+        self.state = State.RAMP_UP
+        self.state_started = started_at
+
+    @property
+    def finished(self) -> bool:
+        return self.state == State.FINISHED
+
+    def ideal_users(self, now: float) -> int:
+        """ Returns the number of users that should be running at the given time. """
+        return self.profile.ideal_users(self.state, now - self.state_started)
+
+    def step(self, now: float, current_users: int) -> Tuple[int, bool, List[State]]:
+        """
+        One iteration of the scheduler: at most one user is launched per iteration.
+
+        :param now: Current time
+        :param current_users: Number of users running, before the launch
+        :return: (ideal number of users, True if the simulator must launch a user, states entered)
+        """
+        ideal_nb_users = self.ideal_users(now)
+        launch = current_users < ideal_nb_users
+        if launch:
+            current_users += 1
+
+        entered = []
+        next_state = self.profile.next_state(self.state, current_users, now - self.state_started)
+        while next_state != self.state:
+            self.state = next_state
+            self.state_started = now
+            entered.append(next_state)
+            next_state = self.profile.next_state(self.state, current_users, 0)
+
+        return ideal_nb_users, launch, entered
+
+    def next_change(self, now: float) -> float:
+        """
+        Returns the first time after now at which step may give another result if no user ends,
+        i.e. the next launch of the ramp up or the end of the full load (inf if there is none).
+        """
+        if self.state == State.RAMP_UP:
+            ideal_nb_users = self.ideal_users(now)
+            at = self.state_started + ideal_nb_users * self.profile.ramp_up_time / self.profile.peak_users
+            while self.ideal_users(at) <= ideal_nb_users:
+                at = math.nextafter(at, math.inf)
+            return at
+
+        if self.state == State.FULL_LOAD:
+            # now - state_started can round below load_time at state_started + load_time, so the first
+            # time at which next_state really leaves the full load is searched like in the ramp up
+            at = max(now, self.state_started + self.profile.load_time)
+            while self.profile.next_state(self.state, self.profile.peak_users, at - self.state_started) == State.FULL_LOAD:
+                at = math.nextafter(at, math.inf)
+            return at
+
+        return math.inf
+
+
+def main():
+    """ Tests that the scheduler follows the profile. """
+    scheduler = Scheduler(LoadProfile(4, 2, 10, 2), 0)
+    assert scheduler.step(0, 0) == (0, False, [])
+    assert scheduler.next_change(0) > 0 and scheduler.ideal_users(scheduler.next_change(0)) == 1
+    assert scheduler.next_change(0.5) == scheduler.next_change(0.1)
+
+    # One user per step, full load entered with the last one
+    assert scheduler.step(1.5, 0) == (3, True, [])
+    assert scheduler.step(1.5, 1) == (3, True, [])
+    assert scheduler.step(2, 2) == (4, True, [])
+    assert scheduler.step(2, 3) == (4, True, [State.FULL_LOAD])
+    assert scheduler.next_change(3) == 12
+
+    assert scheduler.step(12, 4) == (4, False, [State.RAMP_DOWN])
+    assert scheduler.next_change(12) == math.inf
+    assert scheduler.step(13, 2) == (2, False, [])
+    assert scheduler.step(14, 0) == (0, False, [State.FINISHED]) and scheduler.finished
+
+    # 9.8 + 30 - 9.8 < 30: the end of the full load is the first time at which the transition fires
+    scheduler = Scheduler(LoadProfile(50, 10, 30, 10), 0)
+    scheduler.step(9.8, 49)
+    assert scheduler.state == State.FULL_LOAD and scheduler.state_started == 9.8
+    end = scheduler.next_change(20)
+    assert end >= 39.8 and scheduler.step(end, 50) == (50, False, [State.RAMP_DOWN])
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# Description: Exposes the live metrics of a run in the OpenMetrics text format on a /metrics endpoint.
+
+# pylint: disable=C0103
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+import app_metrics
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PREFIX = "loadtest"
+
+# Exported histogram buckets: one per power of two of the LatencyHistogram buckets (1 ms, 2 ms, 4 ms, ...)
+EXPORTED_BUCKETS = list(range(0, app_metrics.HIST_SIZE - 1, app_metrics.SUB_BUCKETS))
+
+
+def cumulative_buckets(histogram: app_metrics.LatencyHistogram) -> List[int]:
+    """ Returns the cumulative counts of the histogram at the EXPORTED_BUCKETS upper bounds. """
+    cumulative = []
+    seen = 0
+    previous = 0
+    for index in EXPORTED_BUCKETS:
+        seen += sum(histogram.counts[previous:index + 1])
+        previous = index + 1
+        cumulative.append(seen)
+    return cumulative
+
+
+def take_snapshot(metrics: app_metrics.LabelledMetrics, **gauges) -> dict:
+    """
+    Copies the aggregates needed by render. The result is never modified afterwards, so it can be
+    published by replacing a reference and read from another thread without a lock.
+
+    :param metrics: Metrics of the run, read on the thread that feeds them
+    :param gauges: Other values to export, e.g. active_users=10 (see render)
+    """
+    series = [(metrics.label_names(key), s.count, s.successes, s.invalid, s.total_time,
+               cumulative_buckets(s.histogram))
+              for key, s in metrics.series.items()]
+    return {"timestamp": time.time(), "series": series, **gauges}
+
+
+def escape(value: str) -> str:
+    """ Escapes a label value. """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(snapshot: dict) -> str:
+    """ Returns the snapshot in the OpenMetrics text format. """
+    lines = []
+
+    def family(name, metric_type, help_text):
+        lines.append(f"# TYPE {PREFIX}_{name} {metric_type}")
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+
+    series = [(",".join(f'{d}="{escape(v)}"' for d, v in zip(app_metrics.DIMENSIONS, labels)), *values)
+              for labels, *values in snapshot["series"]]
+
+    family("requests", "counter", "Requests made by the simulated users.")
+    for labels, count, _, _, _, _ in series:
+        lines.append(f"{PREFIX}_requests_total{{{labels}}} {count}")
+
+    # Validators turn successes into failures after the fact, so the exported counter is the number of
+    # successes by status code (monotonic), the valid ones being status_successes - invalid
+    family("status_successes", "counter", "Requests with a successful status code.")
+    for labels, _, successes, invalid, _, _ in series:
+        lines.append(f"{PREFIX}_status_successes_total{{{labels}}} {successes + invalid}")
+
+    family("invalid", "counter", "Requests rejected by a validator.")
+    for labels, _, _, invalid, _, _ in series:
+        lines.append(f"{PREFIX}_invalid_total{{{labels}}} {invalid}")
+
+    family("request_duration_seconds", "histogram", "Request time.")
+    for labels, count, _, _, total_time, buckets in series:
+        for index, cumulative in zip(EXPORTED_BUCKETS, buckets):
+            lines.append(f'{PREFIX}_request_duration_seconds_bucket{{{labels},le="{app_metrics.bucket_upper_bound(index):.6g}"}} {cumulative}')
+        lines.append(f'{PREFIX}_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"{PREFIX}_request_duration_seconds_count{{{labels}}} {count}")
+        lines.append(f"{PREFIX}_request_duration_seconds_sum{{{labels}}} {total_time}")
+
+    gauges = (("active_users", "Number of simulated users running."),
+              ("peak_users", "Number of users at peak."),
+              ("in_flight_requests", "Number of HTTP requests sent by AppInterface and not answered yet."),
+              ("generator_cpu_usage", "CPU usage of the load generator process (1 = one core)."),
+              ("generator_threads", "Number of threads of the load generator."),
+              ("generator_saturated", "1 if the load generator was saturated during the last second."))
+    for name, help_text in gauges:
+        if name in snapshot:
+            family(name, "gauge", help_text)
+            lines.append(f"{PREFIX}_{name} {snapshot[name]}")
+
+    if "saturation_warnings" in snapshot:
+        family("generator_saturation_warnings", "counter", "Seconds during which the load generator was saturated.")
+        lines.append(f"{PREFIX}_generator_saturation_warnings_total {snapshot['saturation_warnings']}")
+
+    if "queue_depths" in snapshot:
+        family("generator_queue_depth", "gauge", "Items waiting in the queues of the load generator.")
+        for queue, depth in snapshot["queue_depths"].items():
+            lines.append(f'{PREFIX}_generator_queue_depth{{queue="{escape(queue)}"}} {depth}')
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Small HTTP server serving render(get_snapshot()) on /metrics, in a daemon thread."""
+
+    def __init__(self, get_snapshot: Callable[[], dict], host: str = "0.0.0.0", port: int = 9100):
+        """
+        :param get_snapshot: Function returning the last published snapshot, called from the server threads
+        :param host: Address to listen on
+        :param port: Port to listen on (0 to pick a free one, see self.port)
+        """
+        class Handler(BaseHTTPRequestHandler):
+            """Serves /metrics."""
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = render(get_snapshot()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        """ Starts serving. """
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving and closes the socket. """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    """ Tests that the exporter works as expected. """
+    import urllib.request
+    from app_outcome import AppOutcome
+
+    metrics = app_metrics.LabelledMetrics()
+    metrics.record("login", AppOutcome(0.0015, "", 200, "/login", "/"))
+    metrics.record("login", AppOutcome(3, "", 200, "/login", "/"))
+    metrics.record("browse", AppOutcome(0.1, "", 999, '/a"b', "EXCEPTION"))
+
+    snapshot = take_snapshot(metrics, active_users=3, in_flight_requests=1, queue_depths={"results": 2})
+    server = MetricsServer(lambda: snapshot, "127.0.0.1", 0)
+    server.start()
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+        assert response.headers["Content-Type"] == CONTENT_TYPE
+        text = response.read().decode("utf-8")
+    server.stop()
+
+    assert 'loadtest_requests_total{action="login",endpoint="/login",status="2xx"} 2' in text
+    assert 'loadtest_request_duration_seconds_bucket{action="login",endpoint="/login",status="2xx",le="0.002"} 1' in text
+    assert 'loadtest_request_duration_seconds_bucket{action="login",endpoint="/login",status="2xx",le="4.096"} 2' in text
+    assert 'endpoint="/a\\"b"' in text
+    assert "loadtest_active_users 3" in text
+    assert text.endswith("# EOF\n")
+    print(text)
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
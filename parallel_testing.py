@@ -6,12 +6,18 @@ import time
 import threading
 import random
 import collections
-from math import ceil, floor
-from enum import Enum
 import os
 from typing import Union, List, Tuple, Iterable
 from async_real_time_plot import async_real_time_plot, STOP_RTP, SAVE_STOP_RTP
+import app_interface
 import app_outcome
+import app_metrics
+import app_validation
+import session_pool
+import harness_monitor
+import run_recorder
+import metrics_exporter
+from load_profile import LoadProfile, Scheduler, State, TRANSITION_MESSAGES
 from multiprocessing import Process
 
 # Disable pylint warnings
@@ -21,13 +27,7 @@ from multiprocessing import Process
 class Simulator:
     """Simulates a load test."""
 
-    class State(Enum):
-        """State of the simulator."""
-
-        RAMP_UP = 1
-        FULL_LOAD = 2
-        RAMP_DOWN = 3
-        FINISHED = 4
+    State = State
 
     def __init__(
         self,
@@ -38,6 +38,12 @@ class Simulator:
         load_time,
         ramp_down_time,
         timeout,
+        metrics: app_metrics.LabelledMetrics = None,
+        validators: dict = None,
+        sessions: session_pool.SessionPool = None,
+        monitor: harness_monitor.HarnessMonitor = None,
+        record_path: str = None,
+        metrics_port: int = None,
     ):
         """
         :param actions: List of actions to perform. Of the form [(action, probability), ...] where action is a function that takes a user ID and a timeout as parameters and returns an AppOutcome object, and probability is the probability of performing the action
@@ -46,16 +52,22 @@ class Simulator:
         :param load_time: Time to hold peak users
         :param ramp_down_time: Time to ramp down to 0 users
         :param timeout: Max time to wait for a response from the server before considering the request failed
+        :param metrics: Labelled metrics to aggregate the outcomes in (by action, endpoint and status class). If None, a new one is created
+        :param validators: Response validators of each action. Of the form {action: [validator, ...]} where validator is a callable taking an AppOutcome and returning True if it is valid (see app_validation).
+            They run in a worker pool after the timing is recorded, and rejected outcomes are counted as failures once validated
+        :param sessions: If not None, pool of authenticated sessions. Actions then take a user ID, a timeout and a logged in AppInterface as parameters,
+            and the outcomes of the logins are aggregated under the action name "login"
+        :param monitor: Instrumentation of the load generator, warns when the generator itself is saturated. If None, one with the default thresholds is created
+        :param record_path: If not None, every outcome is recorded to this file for the post-run analysis (see run_recorder and run_analysis)
+        :param metrics_port: If not None, live metrics are served in the OpenMetrics format on http://0.0.0.0:<metrics_port>/metrics (see metrics_exporter)
         """
         assert (
             sum((prob for action, prob in actions)) == 1
         ), "Probabilities must sum to 1"
-        assert peak_users > 0, "Peak users must be greater than 0"
-        assert ramp_up_time > 0, "Ramp up time must be greater than 0"
-        assert ramp_down_time > 0, "Ramp down time must be greater than 0"
         assert timeout > 0, "Timeout must be greater than 0"
-        
 
+        self.profile = LoadProfile(
+            peak_users, ramp_up_time, load_time, ramp_down_time)
         self.peak_users = peak_users
         self.ramp_up_time = ramp_up_time
         self.load_time = load_time
@@ -66,14 +78,29 @@ class Simulator:
 
         self.rtp_queue = data_queue
         self.action_outcomes = collections.deque()
+        self.metrics = metrics if metrics is not None else app_metrics.LabelledMetrics()
+        self.sessions = sessions
+        self.validation = app_validation.ValidationPipeline(
+            {app_metrics.action_name(action): v for action, v in (validators or {}).items()})
         self.inform_time = 2  # Inform the user every x seconds via the console
         self.rtp_update_time = 1  # Update the real time plots every x second
         self.retrieve_stats_time = 0.49  # Retrieve stats every x seconds
 
-        self.sim_times = []
+        self.monitor = monitor if monitor is not None else harness_monitor.HarnessMonitor()
+        self.record_path = record_path
+        self.recorder = None
+
+        # Snapshot of the aggregates, replaced (never modified) on each progress update so that the
+        # metrics server reads it without a lock
+        self.snapshot = metrics_exporter.take_snapshot(self.metrics)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics_exporter.MetricsServer(
+                lambda: self.snapshot, port=metrics_port)
 
         self.current_users = 0
         self.thread_pool = set()
+        self.pending_rejections = 0  # Rejected outcomes not deducted from the plotted success rate yet
 
         # Initialize real time plots
         self.artp_process = Process(target=async_real_time_plot, args=(
@@ -86,12 +113,12 @@ class Simulator:
 
         self.artp_process.start()
 
-    def __simulate_user(self, user_id) -> List[app_outcome.AppOutcome]:
+    def __simulate_user(self, user_id) -> List[Tuple[str, List[app_outcome.AppOutcome]]]:
         """
         Simulates a single user's behavior and returns a value.
 
         :param user_id: ID of the user
-        :return: Value returned by the user's actions
+        :return: List of (name of the action performed, value returned by the action), including the login if one was needed
         """
 
         # Sample from actions
@@ -101,26 +128,79 @@ class Simulator:
         )[0]
 
         # Perform action
-        return action(user_id, self.timeout)
-
-    def __launch_user(self, thread):
+        if self.sessions is None:
+            return [(app_metrics.action_name(action), action(user_id, self.timeout))]
+
+        session, login_outcomes = self.sessions.acquire(user_id)
+        logged_in = session.logged_in
+        outcomes = []
+        try:
+            if logged_in:
+                outcomes = action(user_id, self.timeout, session.interface)
+        finally:
+            self.sessions.release(session, outcomes)
+
+        # The action could not be performed: it is counted as a failure of the action too, not only of the login
+        if not logged_in:
+            name = app_metrics.action_name(action)
+            outcomes = [app_outcome.AppOutcome.from_exception(0, name, Exception(f"{name} skipped: login failed"))]
+
+        if login_outcomes:
+            return [("login", login_outcomes), (app_metrics.action_name(action), outcomes)]
+        return [(app_metrics.action_name(action), outcomes)]
+
+    def __run_user(self, user_id, intended_start):
+        """Body of a user thread."""
+        self.monitor.record_start(intended_start)
+        results = self.__simulate_user(user_id)
+        finished_at = time.time()
+        self.result_queue.extend((name, outcomes, finished_at) for name, outcomes in results)
+
+    def __launch_user(self, user_id):
         """Launches a user thread."""
         self.current_users += 1
 
+        thread = threading.Thread(
+            target=self.__run_user,
+            args=(user_id, self.monitor.intended_start()),
+            daemon=True,
+        )
+
         thread.start()
 
         # Register the thread in the thread pool
         self.thread_pool.add(thread)
 
-    def __show_progress(self):
-        """Shows the progress of the load test."""
+    def __show_progress(self, final: bool = False):
+        """
+        Shows the progress of the load test.
+
+        :param final: If True, waits for the remaining validations so that their verdicts are plotted
+        """
         # Get content of the result queue
 
         results = []
         while self.result_queue:
-            result = self.result_queue.popleft()
+            name, result, finished_at = self.result_queue.popleft()
             results.extend(result)
-            self.action_outcomes.append(r.light_copy() for r in result)
+            keys = self.metrics.record_all(name, result)
+            # Outcomes that are validated are recorded with their verdict, once it is known
+            validated = []
+            for key, r in zip(keys, result):
+                if self.validation.will_validate(name, r):
+                    validated.append(((key, finished_at, r.req_time, r.status_code), r))
+                elif self.recorder is not None:
+                    self.recorder.record(finished_at, r.req_time, key[0], key[1], r.status_code, r.success)
+            self.validation.submit(name, validated)
+            self.action_outcomes.append([r.light_copy() for r in result])
+
+        # Apply the verdicts of the validations done since the last call
+        if final:
+            verdicts = self.validation.close()
+        else:
+            self.validation.flush()
+            verdicts = self.validation.collect()
+        self.pending_rejections += self.__apply_validation(verdicts)
 
         # Get stats
         if len(results) > 0:
@@ -128,54 +208,74 @@ class Simulator:
 
             max_resp_req_time, avg_resp_req_time, min_resp_req_time, success_rate = stats
 
+            # Rejected outcomes may come from a previous call, they are deducted from the successes of the
+            # first calls that have enough of them, so that the plotted failures add up to the metrics
+            successes = sum(r.success for r in results)
+            deducted = min(self.pending_rejections, successes)
+            self.pending_rejections -= deducted
+            success_rate = (successes - deducted) / len(results)
+
             self.rtp_queue.append(
                 (True, [self.current_users, len(results), avg_resp_req_time, success_rate, max_resp_req_time, min_resp_req_time]))
 
         else:
             self.rtp_queue.append((True, [self.current_users, 0, 0, 0, 0, 0]))
 
+        # Check that the load generator is not the bottleneck
+        report = self.monitor.sample(threading.active_count(), {
+            "results": len(self.result_queue),
+            "plot": len(self.rtp_queue),
+            "validation": self.validation.pending_batches,
+        })
+        if report["saturation"]:
+            print(
+                f"WARNING: the load generator is saturated ({', '.join(report['saturation'])}), response times are not reliable.")
+
+        self.__publish_snapshot(report)
+
+    def __publish_snapshot(self, report):
+        """Replaces the snapshot read by the metrics server."""
+        self.snapshot = metrics_exporter.take_snapshot(
+            self.metrics,
+            active_users=self.current_users,
+            peak_users=self.peak_users,
+            in_flight_requests=app_interface.IN_FLIGHT.value,
+            generator_cpu_usage=report["cpu_usage"],
+            generator_threads=report["threads"],
+            generator_saturated=int(bool(report["saturation"])),
+            saturation_warnings=self.monitor.saturation_warnings,
+            queue_depths=report["queue_depths"],
+        )
+
+    def __apply_validation(self, verdicts) -> int:
+        """Records the validated outcomes, counts the rejected ones as failures and returns their number."""
+        rejected = 0
+        for (key, finished_at, req_time, status_code), valid in verdicts:
+            if not valid:
+                self.metrics.invalidate(key)
+                rejected += 1
+            if self.recorder is not None:
+                self.recorder.record(finished_at, req_time, key[0], key[1], status_code, valid)
+
+        return rejected
+
     def simulate(self):
         """Simulates the load test."""
 
-        state = self.State.RAMP_UP
+        scheduler = Scheduler(self.profile, time.time())
         time_last_inform = 0
         time_last_plot = 0
-        time_new_state_started = time.time()
 
         thread_number = 0
-        user_thread = None
+        self.monitor.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.record_path is not None:
+            self.recorder = run_recorder.RunRecorder(self.record_path)
 
-        while state != self.State.FINISHED:
+        while not scheduler.finished:
             st = time.time()
 
-            if user_thread is None:
-                thread_number += 1
-                user_thread = threading.Thread(
-                    target=lambda: self.result_queue.append(
-                        self.__simulate_user(thread_number)
-                    ),
-                    daemon=True,
-                )
-
-            if state == self.State.RAMP_UP:
-                # Here we ceil the result e.g. 9.1 users -> we create a new user
-                ideal_nb_users = ceil(
-                    self.peak_users *
-                    (time.time() - time_new_state_started) /
-                    self.ramp_up_time
-                )
-
-            elif state == self.State.FULL_LOAD:
-                ideal_nb_users = self.peak_users
-
-            elif state == self.State.RAMP_DOWN:
-                # Here we floor the result e.g. 9.9 users -> we don't create a new user
-                ideal_nb_users = floor(
-                    self.peak_users *
-                    (1 - (time.time() - time_new_state_started) /
-                        self.ramp_down_time)
-                )
-
             # Adjust number of users #
 
             # Remove threads finished from the thread pool
@@ -186,12 +286,13 @@ class Simulator:
             threads_were_removed = len(self.thread_pool) != self.current_users
             self.current_users = len(self.thread_pool)
 
-            # Add new threads if necessary
-            threads_were_added = False
-            if self.current_users < ideal_nb_users:
-                self.__launch_user(user_thread)
-                user_thread = None
-                threads_were_added = True
+            # Add a new thread if necessary (the step is shared with the virtual simulator)
+            ideal_nb_users, threads_were_added, entered_states = scheduler.step(
+                st, self.current_users)
+            self.monitor.update_deficit(ideal_nb_users - self.current_users)
+            if threads_were_added:
+                thread_number += 1
+                self.__launch_user(thread_number)
 
             # Manage logging
             if (threads_were_added or threads_were_removed) and time.time() - time_last_inform >= self.inform_time:
@@ -205,27 +306,23 @@ class Simulator:
 
                 time_last_plot = time.time()
 
-            self.sim_times.append(time.time() - st)
+            self.monitor.record_loop(time.time() - st)
 
             # Transition logic #
-            if state == self.State.RAMP_UP and self.current_users >= self.peak_users:
-                state = self.State.FULL_LOAD
-                time_new_state_started = time.time()
-                print("Ramp up finished. Starting full load.")
-
-            if state == self.State.FULL_LOAD and time.time() - time_new_state_started >= self.load_time:
-                state = self.State.RAMP_DOWN
-                time_new_state_started = time.time()
-                print("Full load finished. Starting ramp down.")
-
-            if state == self.State.RAMP_DOWN and self.current_users <= 0:
-                state = self.State.FINISHED
-                time_new_state_started = time.time()
-                print("Ramp down finished.")
-
-            if state == self.State.FINISHED:
+            for state in entered_states:
+                print(TRANSITION_MESSAGES[state])
+
+            if scheduler.finished:
                 print("Load testing finished.")
-                self.__show_progress()
+                self.__show_progress(final=True)
+                if self.sessions is not None:
+                    self.sessions.close()
+                print(self.metrics.format_table())
+                if self.recorder is not None:
+                    actions, endpoints, _ = self.metrics.interners
+                    self.recorder.close({"action": actions.names, "endpoint": endpoints.names})
+                self.monitor.stop()
+                print("\n".join(self.monitor.summary()))
                 self.rtp_queue.append(SAVE_STOP_RTP)
 
 
@@ -242,7 +339,7 @@ def main():
     sim = Simulator([(fun, 1)], 5, 5, 5, 5, 10)
     sim.simulate()
 
-    print(max(sim.sim_times))
+    print(sim.monitor.loop_max)
 
     os.system("rtp.pdf")
 
@@ -0,0 +1,363 @@
+# Description: Post-run analysis of recorded runs (see run_recorder) and run-to-run regression report.
+#
+# Usage:
+#   python run_analysis.py report run.bin [run2.bin ...] -o report.html
+#   python run_analysis.py compare baseline.bin --candidate candidate.bin -o report.html --alpha 0.01 --tolerance 0.1
+# compare exits with status 1 if a regression is found, so that it can gate a deploy.
+
+# pylint: disable=C0103
+
+import argparse
+import base64
+import html
+import io
+import json
+import math
+import sys
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+
+import run_recorder
+
+matplotlib.use('agg')  # Use Agg backend to avoid crashing on headless servers
+
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("req_time", "<f8"), ("action", "<u4"),
+                         ("endpoint", "<u4"), ("status", "<i2"), ("success", "u1")])
+assert RECORD_DTYPE.itemsize == run_recorder.RECORD_SIZE, "RECORD_DTYPE must match run_recorder.RECORD_FORMAT"
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class Run:
+    """Samples of one or more recorded runs, as a NumPy structured array."""
+
+    def __init__(self, name: str, samples: np.ndarray, actions: List[str], endpoints: List[str]):
+        self.name = name
+        self.samples = samples
+        self.actions = actions
+        self.endpoints = endpoints
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def load_run(path: str) -> Run:
+    """ Loads a run recorded by run_recorder.RunRecorder. """
+    samples = np.fromfile(path, dtype=RECORD_DTYPE)
+    with open(run_recorder.labels_path(path), "r", encoding="utf-8") as f:
+        labels = json.load(f)["labels"]
+
+    return Run(path, samples, labels["action"], labels["endpoint"])
+
+
+def remap(ids: np.ndarray, names: List[str], index: Dict[str, int]) -> np.ndarray:
+    """ Maps the IDs of a run to the IDs of another list of names (index: name -> new ID). """
+    mapping = np.array([index[name] for name in names], dtype=np.uint32)
+    return mapping[ids]
+
+
+def load_runs(paths: Sequence[str]) -> Run:
+    """ Loads several runs as a single one, the labels are merged by name. """
+    runs = [load_run(path) for path in paths]
+    if len(runs) == 1:
+        return runs[0]
+
+    actions = list(dict.fromkeys(name for run in runs for name in run.actions))
+    endpoints = list(dict.fromkeys(name for run in runs for name in run.endpoints))
+    action_index = {name: i for i, name in enumerate(actions)}
+    endpoint_index = {name: i for i, name in enumerate(endpoints)}
+
+    parts = []
+    for run in runs:
+        samples = run.samples.copy()
+        samples["action"] = remap(samples["action"], run.actions, action_index)
+        samples["endpoint"] = remap(samples["endpoint"], run.endpoints, endpoint_index)
+        parts.append(samples)
+
+    return Run(" + ".join(paths), np.concatenate(parts), actions, endpoints)
+
+
+def group_percentiles(keys: np.ndarray, values: np.ndarray, percentiles: Sequence[float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Computes percentiles of values grouped by key, with a single sort (linear interpolation, like np.percentile).
+
+    :return: (unique keys, count of each key, percentiles of shape (len(unique keys), len(percentiles)))
+    """
+    if len(keys) == 0:
+        return np.array([], dtype=keys.dtype), np.array([], dtype=np.int64), np.zeros((0, len(percentiles)))
+
+    order = np.lexsort((values, keys))
+    sorted_values = values[order]
+    unique_keys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(percentiles, dtype=float)[None, :] / 100)
+    low = np.floor(positions).astype(np.int64)
+    high = np.ceil(positions).astype(np.int64)
+    fraction = positions - low
+
+    return unique_keys, counts, sorted_values[low] * (1 - fraction) + sorted_values[high] * fraction
+
+
+def endpoint_stats(run: Run, percentiles: Sequence[float] = PERCENTILES) -> List[dict]:
+    """ Returns count, error rate, mean and percentiles of the request time of each endpoint. """
+    s = run.samples
+    endpoints, counts, values = group_percentiles(s["endpoint"], s["req_time"], percentiles)
+
+    errors = np.bincount(s["endpoint"], weights=1 - s["success"], minlength=len(run.endpoints))
+    totals = np.bincount(s["endpoint"], weights=s["req_time"], minlength=len(run.endpoints))
+
+    return [{
+        "endpoint": run.endpoints[e],
+        "count": int(c),
+        "error_rate": float(errors[e] / c),
+        "mean": float(totals[e] / c),
+        **{f"p{p:g}": float(v) for p, v in zip(percentiles, row)},
+    } for e, c, row in zip(endpoints, counts, values)]
+
+
+def latency_over_time(run: Run, bin_seconds: float = 10, percentiles: Sequence[float] = (50, 99)) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the request count and the percentiles of the request time in each time bin.
+
+    :return: (start of each bin (s), count of each bin, percentiles of shape (nb bins, len(percentiles)))
+    """
+    bins = np.floor(run.samples["t"] / bin_seconds).astype(np.int64)
+    keys, counts, values = group_percentiles(bins, run.samples["req_time"], percentiles)
+    return keys * bin_seconds, counts, values
+
+
+def latency_histogram_over_time(run: Run, bin_seconds: float = 10, latency_bins: int = 40) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns a 2D histogram of the request times (log scale) over time.
+
+    :return: (time edges, request time edges, counts of shape (nb time bins, nb request time bins))
+    """
+    t, req_time = run.samples["t"], run.samples["req_time"]
+    time_edges = np.arange(0, (t.max() if len(t) else 0) + bin_seconds, bin_seconds)
+    low = max(req_time.min(), 1e-4) if len(req_time) else 1e-4
+    high = max(req_time.max(), low * 10) if len(req_time) else 1
+    latency_edges = np.geomspace(low, high, latency_bins + 1)
+
+    counts, _, _ = np.histogram2d(t, np.clip(req_time, low, high), bins=(time_edges, latency_edges))
+    return time_edges, latency_edges, counts
+
+
+def error_breakdown(run: Run) -> List[dict]:
+    """ Returns the number of failed requests by endpoint and status code, most frequent first. """
+    failed = run.samples[run.samples["success"] == 0]
+    keys = failed["endpoint"].astype(np.int64) * 1000 + failed["status"]
+    unique_keys, counts = np.unique(keys, return_counts=True)
+
+    order = np.argsort(-counts, kind="stable")
+    return [{"endpoint": run.endpoints[k // 1000], "status": int(k % 1000), "count": int(c)}
+            for k, c in zip(unique_keys[order], counts[order])]
+
+
+def normal_p_value(z: float) -> float:
+    """ Two-sided p-value of a standard normal statistic. """
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def mann_whitney(a: np.ndarray, b: np.ndarray) -> Tuple[float, float]:
+    """
+    Mann-Whitney U test (normal approximation, average ranks for ties).
+
+    :return: (z statistic, positive if b tends to be greater than a, two-sided p-value)
+    """
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        return 0.0, 1.0
+
+    pooled = np.sort(np.concatenate((a, b)))
+    ranks_b = (np.searchsorted(pooled, b, "left") + np.searchsorted(pooled, b, "right") + 1) / 2
+    u = ranks_b.sum() - n2 * (n2 + 1) / 2
+
+    sigma = math.sqrt(n1 * n2 * (n1 + n2 + 1) / 12)
+    z = (u - n1 * n2 / 2) / sigma if sigma > 0 else 0.0
+    return z, normal_p_value(z)
+
+
+def two_proportions(errors_a: int, n_a: int, errors_b: int, n_b: int) -> Tuple[float, float]:
+    """
+    Two-proportion z-test.
+
+    :return: (z statistic, positive if the rate of b is greater, two-sided p-value)
+    """
+    if n_a == 0 or n_b == 0:
+        return 0.0, 1.0
+
+    pooled = (errors_a + errors_b) / (n_a + n_b)
+    sigma = math.sqrt(pooled * (1 - pooled) * (1 / n_a + 1 / n_b))
+    if sigma == 0:
+        return 0.0, 1.0
+
+    z = (errors_b / n_b - errors_a / n_a) / sigma
+    return z, normal_p_value(z)
+
+
+def compare_runs(baseline: Run, candidate: Run, alpha: float = 0.01, tolerance: float = 0.1, percentile: float = 99) -> List[dict]:
+    """
+    Compares the endpoints present in both runs.
+
+    An endpoint regresses if its request times are significantly greater (Mann-Whitney, p < alpha) and its
+    percentile grew by more than tolerance, or if its error rate is significantly greater (p < alpha).
+    """
+    base, cand = baseline.samples, candidate.samples
+    cand_index = {name: i for i, name in enumerate(candidate.endpoints)}
+
+    base_order = np.argsort(base["endpoint"], kind="stable")
+    cand_order = np.argsort(cand["endpoint"], kind="stable")
+    base_bounds = np.searchsorted(base["endpoint"][base_order], np.arange(len(baseline.endpoints) + 1))
+    cand_bounds = np.searchsorted(cand["endpoint"][cand_order], np.arange(len(candidate.endpoints) + 1))
+
+    rows = []
+    for e, name in enumerate(baseline.endpoints):
+        if name not in cand_index:
+            continue
+        c = cand_index[name]
+        a = base[base_order[base_bounds[e]:base_bounds[e + 1]]]
+        b = cand[cand_order[cand_bounds[c]:cand_bounds[c + 1]]]
+        if len(a) == 0 or len(b) == 0:
+            continue
+
+        base_value, cand_value = np.percentile(a["req_time"], percentile), np.percentile(b["req_time"], percentile)
+        z, p = mann_whitney(a["req_time"], b["req_time"])
+        base_errors, cand_errors = int(len(a) - a["success"].sum()), int(len(b) - b["success"].sum())
+        z_errors, p_errors = two_proportions(base_errors, len(a), cand_errors, len(b))
+
+        latency_regression = bool(z > 0 and p < alpha and cand_value > base_value * (1 + tolerance))
+        error_regression = bool(z_errors > 0 and p_errors < alpha)
+
+        rows.append({
+            "endpoint": name,
+            "baseline_count": len(a),
+            "candidate_count": len(b),
+            f"baseline_p{percentile:g}": float(base_value),
+            f"candidate_p{percentile:g}": float(cand_value),
+            "change": float(cand_value / base_value - 1) if base_value > 0 else math.inf,
+            "p_value": p,
+            "baseline_error_rate": base_errors / len(a),
+            "candidate_error_rate": cand_errors / len(b),
+            "error_p_value": p_errors,
+            "regression": latency_regression or error_regression,
+        })
+
+    return rows
+
+
+def format_value(value) -> str:
+    """ Formats a value of a table cell. """
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.4g}"
+    return html.escape(str(value))
+
+
+def html_table(rows: List[dict]) -> str:
+    """ Returns an HTML table of rows (dictionaries with the same keys), rows with a true "regression" are highlighted. """
+    if not rows:
+        return "<p>No data.</p>"
+
+    header = "".join(f"<th>{html.escape(k)}</th>" for k in rows[0])
+    body = "".join(
+        ('<tr class="regression">' if row.get("regression") else "<tr>") +
+        "".join(f"<td>{format_value(v)}</td>" for v in row.values()) + "</tr>"
+        for row in rows)
+    return f"<table><tr>{header}</tr>{body}</table>"
+
+
+def time_plot(runs: List[Run], bin_seconds: float) -> str:
+    """ Returns an HTML image of the p50 and p99 request time over time of the runs, and of the request time histogram of the first run. """
+    fig, (ax_time, ax_count, ax_hist) = plt.subplots(3, 1, figsize=(10, 9), sharex=True)
+    for run in runs:
+        starts, counts, values = latency_over_time(run, bin_seconds, (50, 99))
+        ax_time.plot(starts, values[:, 0], label=f"{run.name} p50")
+        ax_time.plot(starts, values[:, 1], label=f"{run.name} p99")
+        ax_count.plot(starts, counts / bin_seconds, label=run.name)
+
+    ax_time.set_ylabel("Response time (s)")
+    ax_time.set_yscale("log")
+    ax_time.legend()
+    ax_count.set_ylabel("Requests / s")
+    ax_count.legend()
+
+    time_edges, latency_edges, counts = latency_histogram_over_time(runs[0], bin_seconds)
+    ax_hist.pcolormesh(time_edges, latency_edges, counts.T, cmap="viridis")
+    ax_hist.set_yscale("log")
+    ax_hist.set_ylabel(f"Response time (s)\n{runs[0].name}")
+    ax_hist.set_xlabel("Time (s)")
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    plt.close(fig)
+    return f'<img src="data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"/>'
+
+
+def html_report(runs: List[Run], comparison: List[dict] = None, bin_seconds: float = 10) -> str:
+    """ Returns the HTML report of the runs, and of their comparison if given. """
+    sections = []
+    if comparison is not None:
+        regressions = sum(row["regression"] for row in comparison)
+        sections.append(f"<h2>Comparison: {regressions} regression(s)</h2>" + html_table(comparison))
+
+    sections.append("<h2>Response time over time</h2>" + time_plot(runs, bin_seconds))
+
+    for run in runs:
+        sections.append(f"<h2>{html.escape(run.name)} ({len(run)} requests)</h2>" +
+                        "<h3>Endpoints</h3>" + html_table(endpoint_stats(run)) +
+                        "<h3>Errors</h3>" + html_table(error_breakdown(run)))
+
+    style = ("body{font-family:sans-serif} table{border-collapse:collapse;margin-bottom:1em}"
+             "td,th{border:1px solid #ccc;padding:2px 6px;text-align:right} .regression{background:#f8d0d0}")
+    return f"<!DOCTYPE html><html><head><title>Load test report</title><style>{style}</style></head><body>" + \
+        "<h1>Load test report</h1>" + "".join(sections) + "</body></html>"
+
+
+def main(argv: List[str] = None) -> int:
+    """ Command line interface, returns the exit status. """
+    parser = argparse.ArgumentParser(description="Analyses recorded load test runs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    report = commands.add_parser("report", help="Report of one or more runs")
+    report.add_argument("runs", nargs="+", help="Recorded runs (binary files of run_recorder)")
+    report.add_argument("--merge", action="store_true", help="Analyse the runs as a single one")
+
+    compare = commands.add_parser("compare", help="Compares a candidate run to a baseline run, exits with 1 on regression")
+    compare.add_argument("baseline", nargs="+", help="Recorded baseline run(s)")
+    compare.add_argument("--candidate", nargs="+", required=True, help="Recorded candidate run(s)")
+    compare.add_argument("--alpha", type=float, default=0.01, help="Significance level")
+    compare.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative growth of the percentile")
+    compare.add_argument("--percentile", type=float, default=99, help="Percentile compared")
+
+    for command in (report, compare):
+        command.add_argument("-o", "--output", default="report.html", help="Path of the HTML report")
+        command.add_argument("--bin", type=float, default=10, help="Time bin (s) of the plots")
+
+    args = parser.parse_args(argv)
+
+    comparison = None
+    if args.command == "report":
+        runs = [load_runs(args.runs)] if args.merge else [load_run(path) for path in args.runs]
+    else:
+        runs = [load_runs(args.baseline), load_runs(args.candidate)]
+        comparison = compare_runs(runs[0], runs[1], args.alpha, args.tolerance, args.percentile)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(html_report(runs, comparison, args.bin))
+    print(f"Report written to {args.output}")
+
+    if comparison is not None:
+        regressions = [row["endpoint"] for row in comparison if row["regression"]]
+        if regressions:
+            print(f"Regression on: {', '.join(regressions)}")
+            return 1
+        print("No regression.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
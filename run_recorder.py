@@ -0,0 +1,93 @@
+# Description: Records every outcome of a run in a compact binary file, to be analysed after the run.
+
+# pylint: disable=C0103
+
+import json
+import struct
+import time
+from typing import Dict, List
+
+# One record per outcome, little-endian and without padding so that it can be loaded with
+# numpy.fromfile (see run_analysis.RECORD_DTYPE):
+# time since the start of the run (s), request time (s), action ID, endpoint ID, status code, success
+RECORD_FORMAT = "<ddIIhB"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+def labels_path(path: str) -> str:
+    """ Returns the path of the file containing the labels of a recorded run. """
+    return path + ".json"
+
+
+class RunRecorder:
+    """Writes the outcomes of a run to a binary file and their labels to a JSON file next to it.
+
+    Not thread safe: it is meant to be fed by the thread draining the result queue.
+    Records are not sorted by time: outcomes checked by validators are written once their verdict is known.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1 << 16, started_at: float = None):
+        """
+        :param path: Path of the binary file (e.g. run.bin), the labels are written to path + ".json"
+        :param buffer_size: Number of bytes buffered before writing to the file
+        :param started_at: Start of the run, the recorded times are relative to it. If None, the current time (time.time())
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.started_at = started_at if started_at is not None else time.time()
+        self.count = 0
+
+        self.buffer = bytearray()
+        self.file = open(path, "wb")
+
+    def record(self, finished_at: float, req_time: float, action_id: int, endpoint_id: int, status_code: int, success: bool):
+        """ Records one outcome, finished_at is a timestamp (time.time()). """
+        self.buffer += struct.pack(RECORD_FORMAT, finished_at - self.started_at, req_time,
+                                   action_id, endpoint_id, status_code, success)
+        self.count += 1
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered records to the file. """
+        self.file.write(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self, labels: Dict[str, List[str]]):
+        """
+        Writes the remaining records and the labels.
+
+        :param labels: Names of the IDs of each dimension, e.g. {"action": [...], "endpoint": [...]}
+        """
+        self.flush()
+        self.file.close()
+
+        with open(labels_path(self.path), "w", encoding="utf-8") as f:
+            json.dump({"started_at": self.started_at, "count": self.count, "labels": labels}, f)
+
+
+def main():
+    """ Tests that the recorder works as expected. """
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "run.bin")
+        recorder = RunRecorder(path, buffer_size=RECORD_SIZE * 2)
+        for i in range(5):
+            recorder.record(recorder.started_at + i, 0.1 * i, 1, 2, 200, True)
+        recorder.close({"action": ["__other__", "a"], "endpoint": ["__other__", "/", "/b"]})
+
+        assert os.path.getsize(path) == 5 * RECORD_SIZE
+        with open(path, "rb") as f:
+            records = list(struct.iter_unpack(RECORD_FORMAT, f.read()))
+        assert records[3] == (3.0, 0.1 * 3, 1, 2, 200, 1)
+        with open(labels_path(path), encoding="utf-8") as f:
+            assert json.load(f)["count"] == 5
+
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# Description: Pool of authenticated sessions, one per concurrent virtual user, reused across actions.
+
+# Ignore too general except clause
+# pylint: disable=W0703
+# pylint: disable=C0103
+
+import collections
+import threading
+import time
+from typing import Callable, List, Tuple, Union
+
+from app_interface import AppInterface
+from app_outcome import AppOutcome
+from data_feeder import FeederExhausted
+
+
+class LoginFlow:
+    """Describes how a virtual user logs in and how to detect that it was logged out."""
+
+    def __init__(self, login_endpoint: str, data: Union[dict, bytes, Callable[[int], Union[dict, bytes]]], token_endpoint: str = None):
+        """
+        :param login_endpoint: Endpoint to post the credentials to (e.g. /compte/connexion)
+        :param data: Data to post (e.g. {"Input.Email": "test", "Input.Password": "test"}), or a function taking the user ID and returning it (e.g. a data_feeder.FileFeeder)
+        :param token_endpoint: If not None, endpoint to get the __RequestVerificationToken from before posting (see AppInterface.get_token_and_post)
+        """
+        self.login_endpoint = login_endpoint
+        self.data = data
+        self.token_endpoint = token_endpoint
+        self.exhausted = False  # True once the data feeder ran out of records
+
+    def login(self, interface: AppInterface, user_id: int) -> List[AppOutcome]:
+        """
+        Logs the session of the interface in and returns the outcomes of the requests made.
+        If the data feeder ran out of records, no request is made and a failed outcome is returned
+        (the first time, a warning is printed).
+        """
+        try:
+            data = self.data(user_id) if callable(self.data) else self.data
+        except FeederExhausted as e:
+            if not self.exhausted:
+                self.exhausted = True
+                print(f"WARNING: no more login data ({e}), the next logins fail without making requests.")
+            return [AppOutcome.from_exception(0, self.login_endpoint, e)]
+
+        if self.token_endpoint is not None:
+            return interface.get_token_and_post(self.token_endpoint, self.login_endpoint, data)
+        return interface.simple_post(self.login_endpoint, data)
+
+    def succeeded(self, outcomes: List[AppOutcome]) -> bool:
+        """
+        Returns True if the login outcomes show a logged in session.
+        Only the last outcome (the POST) is checked for a redirection to the login page: the token
+        is usually fetched from the login page itself.
+        """
+        return len(outcomes) > 0 and all(outcome.success for outcome in outcomes) and not self.logged_out(outcomes[-1:])
+
+    def logged_out(self, outcomes: List[AppOutcome]) -> bool:
+        """ Returns True if one of the outcomes shows that the session is not logged in (401 or redirected to the login page). """
+        for outcome in outcomes:
+            if outcome.status_code == 401:
+                return True
+            if outcome.url_returned.split("?", 1)[0].endswith(self.login_endpoint):
+                return True
+        return False
+
+
+class UserSession:
+    """Authenticated AppInterface of one virtual user."""
+
+    def __init__(self, interface: AppInterface):
+        self.interface = interface
+        self.user_id = None  # ID of the user that logged the session in
+        self.logged_in_at = None  # None if the session must (re)login
+
+    @property
+    def logged_in(self) -> bool:
+        return self.logged_in_at is not None
+
+    def logout(self):
+        """ Forgets the authentication (cookies) of the session, the connections are kept. """
+        self.interface.s.cookies.clear()
+        self.logged_in_at = None
+
+
+class SessionPool:
+    """Pool of logged in sessions.
+
+    A session is used by one user thread at a time: acquire it before the action and release it after.
+    The pool grows up to the number of concurrent users and sessions are reused by the next users,
+    so the login flow only runs once per session (and again on expiry or when the server logged it out).
+    """
+
+    def __init__(self, base_url: str, login_flow: LoginFlow, timeout: int = 10, max_age: float = None):
+        """
+        :param base_url: Base URL of the app
+        :param login_flow: How to log in
+        :param timeout: Timeout of the requests of the sessions
+        :param max_age: Time (s) after which a session logs in again, None to only log in again when logged out by the server
+        """
+        assert max_age is None or max_age > 0, "Max age must be greater than 0"
+
+        self.base_url = base_url
+        self.login_flow = login_flow
+        self.timeout = timeout
+        self.max_age = max_age
+
+        self.idle = collections.deque()
+        self.created = 0
+        self.logins = 0
+        self.lock = threading.Lock()  # Only protects the counters
+
+    def __new_session(self) -> UserSession:
+        with self.lock:
+            self.created += 1
+        return UserSession(AppInterface(self.base_url, self.timeout))
+
+    def acquire(self, user_id: int) -> Tuple[UserSession, List[AppOutcome]]:
+        """
+        Takes an idle session (or creates one) and logs it in if needed.
+
+        :param user_id: ID of the user, passed to the login flow for a new login
+        :return: The session and the outcomes of the login requests (empty if the session was already logged in).
+            If the login raises, the session is returned logged out with the exception as login outcome
+        """
+        try:
+            session = self.idle.pop()
+        except IndexError:
+            session = self.__new_session()
+
+        if session.logged_in and self.max_age is not None and time.time() - session.logged_in_at > self.max_age:
+            session.logout()
+
+        if session.logged_in:
+            return session, []
+
+        with self.lock:
+            self.logins += 1
+
+        st = time.time()
+        try:
+            outcomes = self.login_flow.login(session.interface, user_id)
+        except Exception as e:
+            outcomes = [AppOutcome.from_exception(time.time() - st, self.login_flow.login_endpoint, e)]
+
+        if self.login_flow.succeeded(outcomes):
+            session.user_id = user_id
+            session.logged_in_at = time.time()
+        else:
+            session.logout()
+
+        return session, outcomes
+
+    def release(self, session: UserSession, outcomes: List[AppOutcome]):
+        """
+        Gives a session back to the pool.
+
+        :param session: Session returned by acquire
+        :param outcomes: Outcomes of the action done with the session, used to detect if it was logged out
+        """
+        if session.logged_in and self.login_flow.logged_out(outcomes):
+            session.logout()
+
+        self.idle.append(session)
+
+    def close(self):
+        """ Closes the idle sessions. """
+        while self.idle:
+            self.idle.pop().interface.s.close()
+
+
+def main():
+    """ Tests that the pool reuses and refreshes sessions. """
+
+    class FakeFlow(LoginFlow):
+        """Login flow that does not make requests, with the outcomes of get_token_and_post (GET of the login page, then POST)."""
+
+        def __init__(self, *args, landing_url="https://test/account", **kwargs):
+            super().__init__(*args, **kwargs)
+            self.landing_url = landing_url
+
+        def login(self, interface, user_id):
+            return [AppOutcome(0.1, "", 200, self.token_endpoint, "https://test" + self.token_endpoint),
+                    AppOutcome(0.1, "", 200, self.login_endpoint, self.landing_url)]
+
+    # Wrong credentials: the POST stays on the login page
+    failing = SessionPool("https://test", FakeFlow("/login", {}, "/login", landing_url="https://test/login"))
+    session, outcomes = failing.acquire(1)
+    assert not session.logged_in and len(outcomes) == 2
+    failing.release(session, outcomes)
+    failing.close()
+
+    pool = SessionPool("https://test", FakeFlow("/login", {}, "/login"), max_age=60)
+
+    session, outcomes = pool.acquire(1)
+    assert session.logged_in and len(outcomes) == 2
+    pool.release(session, [AppOutcome(0.1, "", 200, "/account", "https://test/account")])
+
+    same, outcomes = pool.acquire(2)
+    assert same is session and outcomes == []
+
+    other, _ = pool.acquire(3)
+    assert other is not session and pool.created == 2
+
+    # Redirected to the login page -> login again on next acquire
+    pool.release(same, [AppOutcome(0.1, "", 200, "/account", "https://test/login?ReturnUrl=%2Faccount")])
+    assert not same.logged_in
+    again, outcomes = pool.acquire(4)
+    assert again is same and len(outcomes) == 2 and pool.logins == 3
+
+    pool.release(again, [])
+    pool.release(other, [])
+    pool.close()
+
+    class RaisingFlow(LoginFlow):
+        """Login flow whose login raises."""
+
+        def login(self, interface, user_id):
+            raise ValueError("no data")
+
+    # Data feeder with no more records: failed login outcome, warning printed once
+    def exhausted(user_id):
+        raise FeederExhausted("accounts.csv")
+
+    flow = LoginFlow("/login", exhausted)
+    empty = SessionPool("https://test", flow)
+    for user_id in range(2):
+        session, outcomes = empty.acquire(user_id)
+        assert not session.logged_in and not outcomes[0].success and "accounts.csv" in outcomes[0].body
+        empty.release(session, outcomes)
+    assert flow.exhausted and empty.created == 1
+    empty.close()
+
+    raising = SessionPool("https://test", RaisingFlow("/login", {}))
+    session, outcomes = raising.acquire(1)
+    assert not session.logged_in and outcomes[0].status_code == 999 and "no data" in outcomes[0].body
+    raising.release(session, outcomes)
+    assert raising.idle[0] is session
+    raising.close()
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()
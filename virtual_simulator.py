@@ -0,0 +1,346 @@
+# Description: Discrete-event version of the simulator, running on a virtual clock with latency and error models instead of real requests.
+
+# pylint: disable=C0103
+
+import bisect
+import heapq
+import itertools
+import math
+import random
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+import app_metrics
+import run_analysis
+import run_recorder
+from app_outcome import AppOutcome
+from load_profile import LoadProfile, Scheduler, TRANSITION_MESSAGES
+
+
+class LogNormalModel:
+    """Request times drawn from a log-normal distribution, independent of the load."""
+
+    def __init__(self, median: float, sigma: float, error_rate: float = 0, endpoint: str = None, error_status: int = 500):
+        """
+        :param median: Median request time (s)
+        :param sigma: Standard deviation of the log of the request time
+        :param error_rate: Probability that a request fails
+        :param endpoint: Endpoint of the outcomes, the action name if None
+        :param error_status: Status code of the failed requests (e.g. 200 for responses rejected by a validator)
+        """
+        assert median > 0, "Median must be greater than 0"
+        self.mu = math.log(median)
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.endpoint = endpoint
+        self.error_status = error_status
+
+    @staticmethod
+    def fit(req_times: Sequence[float], error_rate: float = 0, endpoint: str = None, error_status: int = 500) -> 'LogNormalModel':
+        """ Fits the model to recorded request times. """
+        logs = np.log(np.maximum(np.asarray(req_times, dtype=np.float64), 1e-6))
+        return LogNormalModel(math.exp(logs.mean()), float(logs.std()), error_rate, endpoint, error_status)
+
+    def sample(self, rng: random.Random, in_flight: int) -> Tuple[float, int, str, bool]:
+        """ Returns (request time, status code, endpoint, success) of one request. """
+        if rng.random() < self.error_rate:
+            return rng.lognormvariate(self.mu, self.sigma), self.error_status, self.endpoint, False
+        return rng.lognormvariate(self.mu, self.sigma), 200, self.endpoint, True
+
+
+class EmpiricalModel:
+    """Request times, status codes, endpoints and successes resampled from a recorded run."""
+
+    def __init__(self, samples: List[Tuple[float, int, str, bool]]):
+        """
+        :param samples: List of (request time, status code, endpoint, success)
+        """
+        assert samples, "Samples must not be empty"
+        self.samples = samples
+
+    def sample(self, rng: random.Random, in_flight: int) -> Tuple[float, int, str, bool]:
+        """ Returns (request time, status code, endpoint, success) of one request. """
+        return self.samples[rng.randrange(len(self.samples))]
+
+
+class MixtureModel:
+    """Draws each request from one of several models, chosen with the given weights (e.g. one model per endpoint)."""
+
+    def __init__(self, models: List[Tuple[object, float]]):
+        """
+        :param models: List of (model, weight), the weights do not need to sum to 1
+        """
+        assert models, "Models must not be empty"
+        self.models = [model for model, _ in models]
+        self.cum_weights = list(itertools.accumulate(weight for _, weight in models))
+
+    def sample(self, rng: random.Random, in_flight: int) -> Tuple[float, int, str, bool]:
+        """ Returns (request time, status code, endpoint, success) of one request. """
+        index = bisect.bisect(self.cum_weights, rng.random() * self.cum_weights[-1])
+        return self.models[min(index, len(self.models) - 1)].sample(rng, in_flight)
+
+
+class QueueModel:
+    """Server with a fixed number of workers, whose response time grows with the requests in flight.
+
+    The service time of a request is exponential. It is stretched once, when the request starts, by
+    in_flight / workers if all the workers are busy, and is not affected by the requests that start
+    after it: an approximation of a saturated server, not a processor sharing queue. Requests longer
+    than the timeout fail with status 999, like exceptions of AppInterface.
+    """
+
+    def __init__(self, service_time: float, workers: int, timeout: float, error_rate: float = 0, endpoint: str = None):
+        """
+        :param service_time: Mean service time (s) of a request on an idle server
+        :param workers: Number of requests served in parallel at full speed
+        :param timeout: Time (s) after which the request fails
+        :param error_rate: Probability that a request fails (status 500)
+        :param endpoint: Endpoint of the outcomes, the action name if None
+        """
+        assert service_time > 0, "Service time must be greater than 0"
+        assert workers > 0, "Number of workers must be greater than 0"
+        self.service_time = service_time
+        self.workers = workers
+        self.timeout = timeout
+        self.error_rate = error_rate
+        self.endpoint = endpoint
+
+    def sample(self, rng: random.Random, in_flight: int) -> Tuple[float, int, str, bool]:
+        """ Returns (request time, status code, endpoint, success) of one request. """
+        req_time = rng.expovariate(1 / self.service_time) * max(1, in_flight / self.workers)
+        if req_time >= self.timeout:
+            return self.timeout, 999, self.endpoint, False
+        if rng.random() < self.error_rate:
+            return req_time, 500, self.endpoint, False
+        return req_time, 200, self.endpoint, True
+
+
+def load_recording(path: str) -> Dict[str, np.ndarray]:
+    """ Reads a run recorded by run_recorder.RunRecorder (see run_analysis.load_run), returns the records of each action with their endpoint names. """
+    run = run_analysis.load_run(path)
+    endpoints = np.array(run.endpoints, dtype=object)
+
+    records = {}
+    for action in np.unique(run.samples["action"]):
+        part = run.samples[run.samples["action"] == action]
+        records[run.actions[action]] = (part, endpoints[part["endpoint"]])
+    return records
+
+
+def empirical_models(path: str) -> Dict[str, EmpiricalModel]:
+    """ Returns an EmpiricalModel for each action of a recorded run. """
+    return {name: EmpiricalModel(list(zip(part["req_time"].tolist(), part["status"].tolist(),
+                                          names.tolist(), part["success"].astype(bool).tolist())))
+            for name, (part, names) in load_recording(path).items()}
+
+
+def fitted_models(path: str) -> Dict[str, object]:
+    """
+    Returns a model of each action of a recorded run: a LogNormalModel fitted to each endpoint of the action,
+    drawn with the recorded frequencies of the endpoints (MixtureModel if there are several).
+    Failures (including the responses rejected by validators) keep their most frequent status code.
+    """
+    models = {}
+    for name, (part, names) in load_recording(path).items():
+        by_endpoint = []
+        for endpoint in dict.fromkeys(names.tolist()):
+            samples = part[names == endpoint]
+            failed = samples["status"][samples["success"] == 0]
+            error_status = 500
+            if len(failed) > 0:
+                statuses, counts = np.unique(failed, return_counts=True)
+                error_status = int(statuses[counts.argmax()])
+            model = LogNormalModel.fit(samples["req_time"], 1 - samples["success"].mean(), endpoint, error_status)
+            by_endpoint.append((model, len(samples)))
+
+        models[name] = by_endpoint[0][0] if len(by_endpoint) == 1 else MixtureModel(by_endpoint)
+    return models
+
+
+class VirtualSimulator:
+    """Runs the load profile of Simulator on a virtual clock.
+
+    The scheduler steps are the ones of Simulator (load_profile.Scheduler): at most one user is launched per
+    step, and the steps take no virtual time. Each user performs one action, whose outcome is drawn from the
+    model of the action and which ends after the drawn request time. The clock jumps from step to step: to
+    the next end of an action, the next launch of the ramp up, the end of the full load or the next row
+    of the timeline. With the same seed, two runs give the same results.
+    """
+
+    def __init__(self, actions, models: Dict[str, object], peak_users, ramp_up_time, load_time, ramp_down_time,
+                 seed: int = 0, progress_time: float = 1, verbose: bool = False,
+                 metrics: app_metrics.LabelledMetrics = None, record_path: str = None):
+        """
+        :param actions: List of actions to perform. Of the form [(action, probability), ...] where action is an action name or the function of Simulator
+        :param models: Model of each action name: an object with a sample(rng, in_flight) method returning (request time, status code, endpoint, success)
+        :param peak_users: Number of users to simulate at peak
+        :param ramp_up_time: Time to ramp up to peak users
+        :param load_time: Time to hold peak users
+        :param ramp_down_time: Time to ramp down to 0 users
+        :param seed: Seed of the random generator
+        :param progress_time: Virtual time (s) between two rows of the timeline
+        :param verbose: Print the state transitions
+        :param metrics: Labelled metrics to aggregate the outcomes in. If None, a new one is created
+        :param record_path: If not None, every outcome is recorded to this file (see run_recorder), with times relative to the virtual clock
+        """
+        assert abs(sum(prob for _, prob in actions) - 1) < 1e-9, "Probabilities must sum to 1"
+        assert progress_time > 0, "Progress time must be greater than 0"
+
+        self.profile = LoadProfile(peak_users, ramp_up_time, load_time, ramp_down_time)
+        self.names = [app_metrics.action_name(action) for action, _ in actions]
+        self.cum_weights = list(itertools.accumulate(prob for _, prob in actions))
+        for name in self.names:
+            assert name in models, f"No model for action {name}"
+
+        self.models = [models[name] for name in self.names]
+        self.rng = random.Random(seed)
+        self.progress_time = progress_time
+        self.verbose = verbose
+        self.metrics = metrics if metrics is not None else app_metrics.LabelledMetrics()
+        self.record_path = record_path
+
+        # (action index, endpoint, status code) -> (label set, series), so that an outcome is recorded without building an AppOutcome
+        self.series_cache: Dict[Tuple[int, str, int], Tuple[Tuple[int, int, int], app_metrics.SeriesStats]] = {}
+
+        self.now = 0.0  # Virtual clock
+        self.current_users = 0
+        self.launched = 0
+        self.timeline = []  # (time, users, requests, avg request time, success rate) every progress_time
+
+    def __series(self, index: int, endpoint: str, status_code: int) -> Tuple[Tuple[int, int, int], app_metrics.SeriesStats]:
+        """Returns the label set and the series of an outcome whose labels are not cached yet."""
+        url = endpoint or self.names[index]
+        key = self.metrics.labels_of(self.names[index], AppOutcome(0, "", status_code, url, url))
+        entry = self.series_cache[(index, endpoint, status_code)] = (key, self.metrics.series_of(key))
+        return entry
+
+    def __launch_user(self, events: list):
+        """Draws the action of a new user and schedules its end."""
+        rng = self.rng
+        index = bisect.bisect(self.cum_weights, rng.random() * self.cum_weights[-1])
+        if index >= len(self.names):
+            index = len(self.names) - 1
+        req_time, status_code, endpoint, success = self.models[index].sample(rng, self.current_users + 1)
+
+        self.current_users += 1
+        self.launched += 1
+        key, stats = self.series_cache.get((index, endpoint, status_code)) or self.__series(index, endpoint, status_code)
+        heapq.heappush(events, (self.now + req_time, self.launched, req_time, status_code, success, key, stats))
+
+    def simulate(self) -> app_metrics.LabelledMetrics:
+        """Runs the load test on the virtual clock and returns the metrics."""
+        recorder = run_recorder.RunRecorder(self.record_path, started_at=0.0) if self.record_path is not None else None
+
+        events = []  # (end time, launch number, request time, status code, success, label set, series)
+        scheduler = Scheduler(self.profile, 0.0)
+        next_change = scheduler.next_change(0.0)
+        next_progress = float(self.progress_time)
+        count, total_time, successes = 0, 0.0, 0  # Since the last row of the timeline
+
+        while not scheduler.finished:
+            # Users whose action ended
+            while events and events[0][0] <= self.now:
+                end, _, req_time, status_code, success, key, stats = heapq.heappop(events)
+                self.current_users -= 1
+                stats.record(req_time, success)
+                count += 1
+                total_time += req_time
+                successes += success
+                if recorder is not None:
+                    recorder.record(end, req_time, key[0], key[1], status_code, success)
+
+            # Same step as the real time scheduler
+            ideal_nb_users, launch, entered_states = scheduler.step(self.now, self.current_users)
+            if launch:
+                self.__launch_user(events)
+            if entered_states:
+                next_change = scheduler.next_change(self.now)
+                if self.verbose:
+                    for state in entered_states:
+                        print(f"[{self.now:.2f}s] {TRANSITION_MESSAGES[state]}")
+
+            if self.now >= next_progress:
+                self.__progress(count, total_time, successes)
+                count, total_time, successes = 0, 0.0, 0
+                next_progress += self.progress_time
+
+            # Another step at the same time if it can launch a user or enter a state. Otherwise the next
+            # step would give the same result, so the clock jumps to the next wake up
+            if entered_states or (launch and self.current_users < ideal_nb_users):
+                continue
+            if self.now >= next_change:
+                next_change = scheduler.next_change(self.now)
+            self.now = min(events[0][0] if events else math.inf, next_change, next_progress)
+
+        self.__progress(count, total_time, successes)
+        if recorder is not None:
+            actions, endpoints, _ = self.metrics.interners
+            recorder.close({"action": actions.names, "endpoint": endpoints.names})
+
+        return self.metrics
+
+    def __progress(self, count: int, total_time: float, successes: int):
+        """Adds a row to the timeline."""
+        self.timeline.append((self.now, self.current_users, count,
+                              total_time / count if count else 0, successes / count if count else 0))
+
+
+def main():
+    """ Tests that the virtual simulator follows the load profile and is deterministic. """
+    import os
+    import tempfile
+    import time
+
+    def run(seed):
+        sim = VirtualSimulator(
+            [("browse", 0.8), ("login", 0.2)],
+            {"browse": QueueModel(0.05, 50, 10, endpoint="/browse"), "login": LogNormalModel(0.2, 0.5, 0.01)},
+            200, 60, 1800, 60, seed=seed)
+        st = time.time()
+        sim.simulate()
+        return sim, time.time() - st
+
+    # Full load whose end rounds below load_time (used to hang)
+    short = VirtualSimulator([("browse", 0.8), ("login", 0.2)],
+                             {"browse": QueueModel(0.05, 50, 10), "login": LogNormalModel(0.2, 0.5)},
+                             50, 10, 30, 10, seed=1)
+    short.simulate()
+    assert 49 <= short.now <= 51, short.now
+
+    # Models of a recording: endpoints and rejected responses (status 200, not successful) are kept
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "run.bin")
+        recorder = run_recorder.RunRecorder(path, started_at=0.0)
+        for i in range(400):
+            recorder.record(i, 0.1, 1, 1 + i % 2, 200, i % 4 != 0)
+        recorder.close({"action": ["__other__", "login"], "endpoint": ["__other__", "/login", "/account"]})
+
+        rng = random.Random(0)
+        empirical = [empirical_models(path)["login"].sample(rng, 1) for _ in range(1000)]
+        fitted = fitted_models(path)["login"]
+        drawn = [fitted.sample(rng, 1) for _ in range(1000)]
+
+    assert {endpoint for _, _, endpoint, _ in empirical} == {"/login", "/account"}
+    assert (200, False) in {(status, success) for _, status, _, success in empirical}
+    assert {endpoint for _, _, endpoint, _ in drawn} == {"/login", "/account"}
+    assert 0.15 < sum(not success for _, _, _, success in drawn) / len(drawn) < 0.35
+    assert all(status == 200 for _, status, _, _ in drawn)
+
+    sim, duration = run(1)
+    again, _ = run(1)
+    other, _ = run(2)
+
+    # Ramp up + load + ramp down, ended by the last user
+    assert 1915 <= sim.now <= 1925, sim.now
+    assert max(users for _, users, _, _, _ in sim.timeline) == 200
+    assert sim.timeline == again.timeline
+    assert sim.timeline != other.timeline
+
+    print(sim.metrics.format_table("action", "endpoint"))
+    print(f"{sim.now:.0f}s simulated in {duration:.2f}s ({sim.now / duration:.0f}x real time)")
+    print("Success!")
+
+
+if __name__ == "__main__":
+    main()